@@ -0,0 +1,134 @@
+from scipy.sparse import csc_matrix
+
+import numpy as np
+
+# Number of set bits in every byte
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_columns(x):
+    """
+    Pack a dense boolean matrix into one uint64 bitset per column.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        x.shape = (num_rows, num_cols)
+
+    Returns
+    -------
+    words : np.ndarray
+        words.shape = (num_cols, ceil(num_rows / 64)), dtype uint64.
+    """
+    x = np.asarray(x, dtype=bool)
+    num_rows, num_cols = x.shape
+    num_words = (num_rows + 63) // 64
+    padded = np.zeros((num_words * 64, num_cols), dtype=bool)
+    padded[:num_rows] = x
+    return np.ascontiguousarray(np.packbits(padded, axis=0).T).view(np.uint64)
+
+def unpack_columns(words, num_rows):
+    """
+    Inverse of pack_columns.
+    """
+    return np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1)[:, :num_rows].T.astype(bool)
+
+def popcount(words):
+    """
+    Number of set bits in each row of words.
+    """
+    return POPCOUNT_TABLE[np.ascontiguousarray(words).view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+class BitFeatureMatrix(object):
+    """
+    A boolean feature matrix stored as one packed bitset (uint64 words) per program.
+
+    Uses one bit per entry regardless of sparsity. Column slices with X[:, a:b]
+    are zero-copy views. Convert with tocsr / tocsc / toarray for learners that
+    need scipy or numpy input.
+    """
+    def __init__(self, words, num_rows):
+        self.words = words
+        self.num_rows = num_rows
+
+    @classmethod
+    def from_dense(cls, x):
+        x = np.asarray(x, dtype=bool)
+        return cls(pack_columns(x), x.shape[0])
+
+    @classmethod
+    def from_sparse(cls, X, column_block_size=1000):
+        X = X.tocsc()
+        words = np.zeros((X.shape[1], (X.shape[0] + 63) // 64), dtype=np.uint64)
+        for i in range(0, X.shape[1], column_block_size):
+            words[i:i+column_block_size] = pack_columns(X[:, i:i+column_block_size].toarray())
+        return cls(words, X.shape[0])
+
+    @property
+    def shape(self):
+        return (self.num_rows, self.words.shape[0])
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def __getitem__(self, key):
+        rows, cols = key
+        assert rows == slice(None), "Only column selection is supported"
+        if isinstance(cols, slice):
+            return BitFeatureMatrix(self.words[cols], self.num_rows)
+        return BitFeatureMatrix(self.words[np.asarray(cols, dtype=int)], self.num_rows)
+
+    def column(self, j):
+        return unpack_columns(self.words[j:j+1], self.num_rows)[:, 0]
+
+    def toarray(self):
+        return unpack_columns(self.words, self.num_rows)
+
+    def tocsc(self, dtype=bool, column_block_size=1000):
+        blocks = []
+        indptr = [0]
+        for i in range(0, self.words.shape[0], column_block_size):
+            block = unpack_columns(self.words[i:i+column_block_size], self.num_rows)
+            cols, rows = np.nonzero(block.T)
+            blocks.append(rows.astype(np.int32))
+            indptr.extend(indptr[-1] + np.cumsum(np.bincount(cols, minlength=block.shape[1])))
+        indices = np.concatenate(blocks) if len(blocks) > 0 else np.zeros(0, dtype=np.int32)
+        data = np.ones(len(indices), dtype=dtype)
+        return csc_matrix((data, indices, np.array(indptr, dtype=np.int32)), shape=self.shape)
+
+    def tocsr(self, dtype=bool):
+        return self.tocsc(dtype=dtype).tocsr()
+
+def get_column_prefix(X, num_columns):
+    """
+    X[:, :num_columns] without copying, for a csc_matrix or BitFeatureMatrix.
+
+    Scipy column slicing rebuilds the index arrays, while in CSC the first
+    columns are a prefix of data, indices and indptr.
+    """
+    if isinstance(X, csc_matrix):
+        end = X.indptr[num_columns]
+        return csc_matrix((X.data[:end], X.indices[:end], X.indptr[:num_columns+1]),
+                          shape=(X.shape[0], num_columns), copy=False)
+    return X[:, :num_columns]
+
+def bit_hstack(matrices):
+    """
+    Concatenate BitFeatureMatrix columns (all with the same rows).
+    """
+    assert len(set(X.num_rows for X in matrices)) == 1
+    return BitFeatureMatrix(np.vstack([X.words for X in matrices]), matrices[0].num_rows)
+
+def bit_vstack(matrices, column_block_size=1000):
+    """
+    Concatenate BitFeatureMatrix rows (all with the same programs).
+    """
+    num_cols = matrices[0].shape[1]
+    num_rows = sum(X.num_rows for X in matrices)
+    words = np.zeros((num_cols, (num_rows + 63) // 64), dtype=np.uint64)
+    for i in range(0, num_cols, column_block_size):
+        block = np.vstack([unpack_columns(X.words[i:i+column_block_size], X.num_rows) for X in matrices])
+        words[i:i+column_block_size] = pack_columns(block)
+    return BitFeatureMatrix(words, num_rows)
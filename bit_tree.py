@@ -0,0 +1,134 @@
+from bit_matrix import BitFeatureMatrix, pack_columns, popcount
+from incremental_dt import get_weighted_gini
+
+import numpy as np
+
+
+class BitsetDecisionTree(object):
+    """
+    A decision tree for boolean features stored as a BitFeatureMatrix.
+
+    Each node keeps its samples as a bitset, and the class counts of every
+    candidate split come from popcounts of (column & node & positives), over
+    the words where the node still has samples. Splits minimize the weighted
+    gini impurity of the children, as in DecisionTreeClassifier, plus
+    prior_weight times the -log prior of the feature, so that among similar
+    splits the simpler program is preferred. Nodes are split until they are
+    pure or no feature separates their samples.
+
+    The result is read off directly as PLP clauses (see get_clauses).
+    """
+    def __init__(self, prior_weight=0., random_state=None, tolerance=1e-12):
+        self.prior_weight = prior_weight
+        self.random_state = random_state
+        self.tolerance = tolerance
+        # Per node: (feature, left, right) for splits, (None, is_true) for leaves
+        self.nodes = []
+
+    def fit(self, X, y, feature_log_probs=None):
+        """
+        Parameters
+        ----------
+        X : BitFeatureMatrix
+        y : [ bool ]
+        feature_log_probs : [ float ] or None
+            Prior log probability of each column, used by prior_weight and to
+            break ties (higher prior first) when random_state is None.
+        """
+        rng = None if self.random_state is None else np.random.RandomState(self.random_state)
+        words = X.words
+        num_features = words.shape[0]
+        positives = pack_columns(np.asarray(y, dtype=bool)[:, None])[0]
+        root = pack_columns(np.ones((X.num_rows, 1), dtype=bool))[0]
+
+        if feature_log_probs is None:
+            feature_log_probs = np.zeros(num_features)
+        feature_log_probs = np.asarray(feature_log_probs, dtype=float)
+        prior_cost = -self.prior_weight * feature_log_probs
+        # Deterministic tie-break: highest prior, then lowest index
+        preference = np.lexsort((np.arange(num_features), -feature_log_probs))
+
+        self.nodes = [None]
+        stack = [(0, root)]
+
+        while len(stack) > 0:
+            node_id, samples = stack.pop()
+            active = np.flatnonzero(samples)
+            samples, node_positives = samples[active], samples[active] & positives[active]
+            num_samples, num_positive = popcount(samples), popcount(node_positives)
+
+            if num_positive == 0 or num_positive == num_samples:
+                self.nodes[node_id] = (None, num_positive > num_samples - num_positive)
+                continue
+
+            columns = words[:, active]
+            num_ones = popcount(columns & samples)
+            num_positive_ones = popcount(columns & node_positives)
+            splits = (num_ones > 0) & (num_ones < num_samples)
+
+            if not splits.any():
+                self.nodes[node_id] = (None, num_positive > num_samples - num_positive)
+                continue
+
+            cost = (get_weighted_gini(num_ones, num_positive_ones) +
+                    get_weighted_gini(num_samples - num_ones, num_positive - num_positive_ones)) / num_samples
+            cost = np.where(splits, cost + prior_cost, np.inf)
+            best = np.flatnonzero(cost <= cost.min() + self.tolerance)
+
+            if rng is not None:
+                feature = rng.choice(best)
+            else:
+                feature = preference[np.isin(preference, best)][0]
+
+            left, right = len(self.nodes), len(self.nodes) + 1
+            self.nodes.extend([None, None])
+            self.nodes[node_id] = (feature, left, right)
+
+            full_samples = np.zeros_like(root)
+            full_samples[active] = samples
+            stack.append((right, full_samples & words[feature]))
+            stack.append((left, full_samples & ~words[feature]))
+
+        return self
+
+    def get_clauses(self):
+        """
+        Returns
+        -------
+        clauses : [ [ (int, bool) ] ]
+            (feature, is_positive) literals on the path to each true leaf.
+        """
+        clauses = []
+        stack = [(0, [])]
+
+        while len(stack) > 0:
+            node_id, path = stack.pop()
+            node = self.nodes[node_id]
+            if node[0] is None:
+                if node[1]:
+                    clauses.append(path)
+                continue
+            feature, left, right = node
+            stack.append((left, path + [(feature, False)]))
+            stack.append((right, path + [(feature, True)]))
+
+        return clauses
+
+def learn_bitset_decision_trees(X, y, num_dts, feature_log_probs=None, prior_weight=0.):
+    """
+    BitsetDecisionTree version of learn_single_batch_decision_trees.
+
+    The first tree breaks ties deterministically; the others with seeds 1, 2, ...
+
+    Returns
+    -------
+    trees : [ BitsetDecisionTree ]
+    """
+    if not isinstance(X, BitFeatureMatrix):
+        X = BitFeatureMatrix.from_sparse(X)
+
+    trees = []
+    for seed in range(num_dts):
+        tree = BitsetDecisionTree(prior_weight=prior_weight, random_state=seed if seed > 0 else None)
+        trees.append(tree.fit(X, y, feature_log_probs))
+    return trees
@@ -1,65 +1,283 @@
-from scipy.sparse import csr_matrix, save_npz, load_npz
+from bit_matrix import BitFeatureMatrix
+from policy import StateActionProgram, PLPPolicy
+from scipy.sparse import issparse, save_npz, load_npz
+from functools import wraps
 
+import ast
 import glob
-import pickle
+import hashlib
+import inspect
+import json
 import os
+import shutil
+import uuid
+import numpy as np
 
+package_dir = os.path.dirname(os.path.abspath(__file__))
 
-def cache_single_output(output, cache_file):
-    if isinstance(output, csr_matrix):
-        save_npz(cache_file, output)
-    else:
-        with open(cache_file, 'wb') as f:
-            pickle.dump(output, f)
-    print("Cached output to {}.".format(cache_file))
+# Module name -> hash of the module and the package modules it imports
+code_versions = {}
 
-def load_single_cache_output(cache_file):
-    if '.npz' in cache_file:
-        output = load_npz(cache_file)
-    else:
-        with open(cache_file, 'rb') as f:
-            output = pickle.load(f)
 
-    print("Loaded cache from {}.".format(cache_file))
-    return output
+def get_imported_modules(module_name):
+    """
+    The modules of this package that a module of this package imports,
+    leaving out imports under `if __name__ == "__main__"`.
+    """
+    with open(os.path.join(package_dir, module_name + '.py'), 'rb') as f:
+        tree = ast.parse(f.read())
+
+    def is_main_block(node):
+        return isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and \
+            isinstance(node.test.left, ast.Name) and node.test.left.id == '__name__'
+
+    names = set()
+    for node in (n for statement in tree.body if not is_main_block(statement) for n in ast.walk(statement)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+            names.add(node.module)
+
+    return sorted(name for name in names if os.path.isfile(os.path.join(package_dir, name + '.py')))
+
+def get_code_version(module_name):
+    """
+    Hash of a module of this package and of every package module it imports,
+    directly or indirectly, so that cached outputs are not reused after the
+    code that produced them changes.
+    """
+    if module_name not in code_versions:
+        dependencies = set()
+        pending = [module_name]
+        while len(pending) > 0:
+            name = pending.pop()
+            if name not in dependencies:
+                dependencies.add(name)
+                pending.extend(get_imported_modules(name))
+
+        code_hash = hashlib.sha1()
+        for name in sorted(dependencies):
+            with open(os.path.join(package_dir, name + '.py'), 'rb') as f:
+                code_hash.update(name.encode('utf-8'))
+                code_hash.update(f.read())
+        code_versions[module_name] = code_hash.hexdigest()
+    return code_versions[module_name]
 
-def manage_cache(cache_dir, extensions):
+def get_module_name(func):
+    """
+    The name of the package module that defines func, also when it is run as
+    a script (where func.__module__ is '__main__').
+    """
+    return os.path.splitext(os.path.basename(inspect.getfile(func)))[0]
 
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
+def normalize_argument(x):
+    """
+    Convert a function argument into a JSON-serializable value that only
+    depends on its content (e.g. dicts are sorted and ranges are listed).
+    """
+    if x is None or isinstance(x, (bool, str)):
+        return x
+    if isinstance(x, (int, np.integer)):
+        return int(x)
+    if isinstance(x, (float, np.floating)):
+        return {'float': repr(float(x))}
+    if isinstance(x, dict):
+        return {'dict': sorted([normalize_argument(k), normalize_argument(v)] for k, v in x.items())}
+    if isinstance(x, (list, tuple, range)):
+        return [normalize_argument(v) for v in x]
+    if isinstance(x, np.ndarray):
+        return {'array': [x.dtype.str, list(x.shape), hashlib.sha1(np.ascontiguousarray(x).tobytes()).hexdigest()]}
+    if type(x).__name__ == 'StateActionProgram':
+        return {'program': str(x)}
+    raise TypeError("Cannot build a cache key from {}".format(type(x)))
 
-    if isinstance(extensions, str):
-        single_output = True
-        extensions = [extensions]
+def save_output(output, directory, name):
+    """
+    Write output under directory and return a description for load_output.
+
+    Tuples are stored element by element, matrices as .npz / .npy files, and
+    policies, programs and plain values (numbers, strings, lists) as JSON.
+    Nothing is pickled, so entries do not depend on how classes are defined.
+    """
+    if isinstance(output, tuple):
+        return ('tuple', [save_output(x, directory, '{}_{}'.format(name, i)) for i, x in enumerate(output)])
+    if isinstance(output, BitFeatureMatrix):
+        np.save(os.path.join(directory, name + '.npy'), output.words)
+        return ('bits', name + '.npy', output.num_rows)
+    if issparse(output):
+        save_npz(os.path.join(directory, name + '.npz'), output)
+        return ('sparse', name + '.npz')
+    if isinstance(output, np.ndarray) and output.dtype != object:
+        np.save(os.path.join(directory, name + '.npy'), output)
+        return ('array', name + '.npy')
+
+    if isinstance(output, PLPPolicy):
+        kind = 'policy'
+        value = {'plps': [plp.program for plp in output.plps], 'probs': [float(p) for p in output.probs],
+                 'map_choices': output.map_choices, 'vectorized': output.vectorized, 'flat': output.flat}
+    elif isinstance(output, list) and len(output) > 0 and all(isinstance(x, StateActionProgram) for x in output):
+        kind = 'programs'
+        value = [x.program for x in output]
     else:
-        single_output = False
+        kind = 'json'
+        value = output
+
+    try:
+        text = json.dumps(value)
+    except TypeError:
+        raise TypeError("Cannot cache an output of type {}".format(type(output)))
+    # Lists of numpy numbers are not JSON, and tuples inside lists would come back as lists
+    if json.loads(text) != value:
+        raise TypeError("Cannot cache an output of type {}".format(type(output)))
+
+    with open(os.path.join(directory, name + '.json'), 'w') as f:
+        f.write(text)
+    return (kind, name + '.json')
+
+def load_output(description, directory):
+    kind = description[0]
+    if kind == 'tuple':
+        return tuple(load_output(d, directory) for d in description[1])
+    if kind == 'bits':
+        return BitFeatureMatrix(np.load(os.path.join(directory, description[1]), mmap_mode='c'), description[2])
+    if kind == 'sparse':
+        return load_npz(os.path.join(directory, description[1]))
+    if kind == 'array':
+        return np.load(os.path.join(directory, description[1]), mmap_mode='c')
+
+    with open(os.path.join(directory, description[1])) as f:
+        value = json.load(f)
+    if kind == 'policy':
+        return PLPPolicy([StateActionProgram(plp) for plp in value['plps']], value['probs'],
+                         map_choices=value['map_choices'], vectorized=value['vectorized'], flat=value['flat'])
+    if kind == 'programs':
+        return [StateActionProgram(x) for x in value]
+    return value
+
+def get_directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, _, filenames in os.walk(directory) for filename in filenames)
+
+
+class OutputCache(object):
+    """
+    A content-addressed on-disk cache for function outputs.
+
+    Entries are keyed by a hash of the function name, the normalized arguments
+    (see normalize_argument) and the code version of the function's module
+    (see get_code_version), are
+    written to a temporary directory and renamed into place, and are evicted
+    least recently used first once the cache exceeds max_size bytes.
+    Matrices are stored as .npz / .npy files and dense arrays are memory-mapped
+    when loaded; other outputs are stored as JSON (see save_output).
+
+    Caching is off while cache_dir is None.
+
+        output_cache = OutputCache()
+
+        @output_cache.cached(ignore=('feature_store',))
+        def run(...):
+            ...
+
+        output_cache.cache_dir = 'cache'
+    """
+    def __init__(self, cache_dir=None, max_size=10 * 2**30, version_tag=''):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.version_tag = version_tag
+
+    def cached(self, ignore=()):
+        """
+        Decorator. Arguments named in ignore (e.g. in-memory caches) are left
+        out of the key and must not change the output.
+        """
+        def decorator(func):
+            signature = inspect.signature(func)
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if self.cache_dir is None:
+                    return func(*args, **kwargs)
+
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                arguments = {name: value for name, value in bound.arguments.items() if name not in ignore}
+                key = self.get_key(func, arguments)
+
+                found, output = self.load(key)
+                if not found:
+                    output = func(*args, **kwargs)
+                    self.store(key, output)
+                return output
+
+            return wrapper
+        return decorator
+
+    def get_key(self, func, arguments):
+        module_name = get_module_name(func)
+        description = [module_name, func.__name__, get_code_version(module_name), self.version_tag,
+                       normalize_argument(arguments)]
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
 
-    def decorator_manage_cache(func):
-        def wrapper_cache_output(*args, **kwargs):
-            run_id = "-".join([str(arg) for arg in args])
+    def load(self, key):
+        """
+        Returns
+        -------
+        found : bool
+        output : Any
+        """
+        entry_dir = self.get_entry_dir(key)
+        meta_file = os.path.join(entry_dir, 'meta.json')
+        if not os.path.isfile(meta_file):
+            return False, None
 
-            cache_file = os.path.join(cache_dir, "{}_{}_{}{}".format(func.__name__, run_id, 0, extensions[0]))
+        try:
+            with open(meta_file) as f:
+                description = json.load(f)
+            output = load_output(description, entry_dir)
+        except (IOError, OSError, ValueError):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return False, None
 
-            if not os.path.isfile(cache_file):
-                outputs = func(*args, **kwargs)
-                if single_output:
-                    outputs = [outputs]
+        # Mark as recently used
+        os.utime(entry_dir, None)
+        print("Loaded cache from {}.".format(entry_dir))
+        return True, output
 
-                for i, (output, extension) in enumerate(zip(outputs, extensions)):
-                    cache_file = os.path.join(cache_dir, "{}_{}_{}{}".format(func.__name__, run_id, i, extension))
-                    cache_single_output(output, cache_file)
+    def store(self, key, output):
+        entry_dir = self.get_entry_dir(key)
+        temp_dir = '{}.tmp-{}-{}'.format(entry_dir, os.getpid(), uuid.uuid4().hex)
+        os.makedirs(temp_dir)
 
-            num_cache_files = len(glob.glob(cache_dir + "/{}_{}_*.".format(func.__name__, run_id)))
+        try:
+            description = save_output(output, temp_dir, 'output')
+            with open(os.path.join(temp_dir, 'meta.json'), 'w') as f:
+                json.dump(description, f)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # Another process stored the same entry first
+            if not os.path.isdir(entry_dir):
+                raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
-            outputs = []
-            for i, extension in enumerate(extensions):
-                cache_file = os.path.join(cache_dir, "{}_{}_{}{}".format(func.__name__, run_id, i, extension))
-                output = load_single_cache_output(cache_file)
-                outputs.append(output)
+        print("Cached output to {}.".format(entry_dir))
+        self.evict()
 
-            if single_output:
-                return outputs[0]
-            return tuple(outputs)
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size.
+        """
+        entries = [entry_dir for entry_dir in glob.glob(os.path.join(self.cache_dir, '*', '*'))
+                   if os.path.isdir(entry_dir) and '.tmp-' not in entry_dir]
+        sizes = {entry_dir: get_directory_size(entry_dir) for entry_dir in entries}
+        total_size = sum(sizes.values())
 
-        return wrapper_cache_output
-    return decorator_manage_cache
+        for entry_dir in sorted(entries, key=os.path.getmtime):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= sizes[entry_dir]
@@ -0,0 +1,73 @@
+import hashlib
+import importlib.util
+import marshal
+import os
+
+# If set, compiled programs are also kept on disk in this directory so that new
+# processes and later runs load bytecode instead of parsing the program again.
+code_cache_dir = None
+
+# Process-local table. Workers forked from a WorkerPool start with a copy of the
+# parent's table, so programs compiled before the pool was created are shared.
+max_num_cached_codes = 100000
+cached_codes = {}
+
+
+def get_program_key(program):
+    return hashlib.sha1(program.encode('utf-8')).hexdigest()
+
+def get_code_filename(key):
+    # Marshalled bytecode is only valid for the interpreter version that wrote it
+    version = importlib.util.MAGIC_NUMBER.hex()
+    return os.path.join(code_cache_dir, version, key[:2], key + '.marshal')
+
+def load_code(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+def save_code(code, filename):
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_filename, 'wb') as f:
+        marshal.dump(code, f)
+    os.replace(temp_filename, filename)
+
+def get_program_code(program):
+    """
+    Compiled code of 'lambda s, a: ' + program, ready to be eval'd.
+
+    Looks the program up by hash in this process, then in code_cache_dir, and
+    only compiles it if both miss.
+
+    Parameters
+    ----------
+    program : str
+
+    Returns
+    -------
+    code : code
+    """
+    key = get_program_key(program)
+    code = cached_codes.get(key)
+    if code is not None:
+        return code
+
+    filename = None
+    if code_cache_dir is not None:
+        filename = get_code_filename(key)
+        code = load_code(filename)
+
+    if code is None:
+        code = compile('lambda s, a: ' + program, '<program {}>'.format(key[:12]), 'eval')
+        if filename is not None:
+            save_code(code, filename)
+
+    if len(cached_codes) >= max_num_cached_codes:
+        cached_codes.clear()
+    cached_codes[key] = code
+    return code
@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+
 import numpy as np
 
 
@@ -24,11 +26,7 @@ def cell_is_value(value, cell, obs):
     return (focus == value)
 
 def at_cell_with_value(value, local_program, obs):
-    matches = np.argwhere(obs == value)
-    if len(matches) == 0:
-        cell = None
-    else:
-        cell = matches[0]
+    cell = get_observation_index(obs).first_cell(value)
     return local_program(cell, obs)
 
 def at_action_cell(local_program, cell, obs):
@@ -57,10 +55,182 @@ def scanning(direction, true_condition, false_condition, cell, obs, max_timeout=
     return False
 
 
+### Per-state index
+max_num_cached_indices = 1000
+cached_indices = {}
+# (obs, ObservationIndex) while in observation_index_scope(obs)
+current_index = None
+
+def shift_grid(x, direction, fill):
+    """
+    y[r, c] = x[r + direction[0], c + direction[1]], or fill out of bounds.
+    """
+    y = np.full(x.shape, fill, dtype=x.dtype)
+    dr, dc = direction
+    num_rows, num_cols = x.shape
+    if abs(dr) >= num_rows or abs(dc) >= num_cols:
+        return y
+    y[max(0, -dr):num_rows - max(0, dr), max(0, -dc):num_cols - max(0, dc)] = \
+        x[max(0, dr):num_rows - max(0, -dr), max(0, dc):num_cols - max(0, -dc)]
+    return y
+
+class ObservationIndex(object):
+    """
+    Lookup tables for one state, built lazily and shared by every program
+    evaluated on it (see get_observation_index).
+
+    - first_cell(value): what at_cell_with_value looks at.
+    - value_ray(value, direction)[r, c]: how many steps from (r, c) along
+      direction to the first cell with value, or inf.
+    - ray_length(direction)[r, c]: how many cells from (r, c) along direction
+      are in bounds.
+
+    Together they answer scanning for cell_is_value conditions in O(1) (see
+    scan_table and scan). Only flat programs (see flat_programs) use scan; the
+    scanning primitive gets its conditions as opaque functions and keeps its
+    loop.
+    """
+    def __init__(self, obs):
+        self.obs = obs
+        self.matches = {}
+        self.first_cells = {}
+        self.value_rays = {}
+        self.ray_lengths = {}
+        self.scan_tables = {}
+
+    def get_matches(self, value):
+        if value not in self.matches:
+            self.matches[value] = np.asarray(self.obs == value, dtype=bool)
+        return self.matches[value]
+
+    def first_cell(self, value):
+        if value not in self.first_cells:
+            matches = np.argwhere(self.get_matches(value))
+            self.first_cells[value] = None if len(matches) == 0 else (int(matches[0, 0]), int(matches[0, 1]))
+        return self.first_cells[value]
+
+    def ray_length(self, direction):
+        if direction not in self.ray_lengths:
+            rows, cols = np.indices(self.obs.shape)
+            length = np.full(self.obs.shape, np.inf)
+            for positions, step, size in ((rows, direction[0], self.obs.shape[0]), (cols, direction[1], self.obs.shape[1])):
+                if step > 0:
+                    length = np.minimum(length, (size - 1 - positions) // step + 1)
+                elif step < 0:
+                    length = np.minimum(length, positions // -step + 1)
+            self.ray_lengths[direction] = length
+        return self.ray_lengths[direction]
+
+    def value_ray(self, value, direction):
+        key = (value, direction)
+        if key not in self.value_rays:
+            matches = self.get_matches(value)
+            ray = np.full(self.obs.shape, np.inf)
+            for steps in range(int(min(np.max(self.ray_length(direction)), matches.size))):
+                shifted_matches = shift_grid(matches, (steps * direction[0], steps * direction[1]), False)
+                ray[np.isinf(ray) & shifted_matches] = steps
+            self.value_rays[key] = ray
+        return self.value_rays[key]
+
+    def scan_table(self, direction, true_value, false_value, max_timeout=50):
+        """
+        Output of scan for every in-bounds first scanned cell, as nested lists.
+        """
+        key = (direction, true_value, false_value, max_timeout)
+        if key not in self.scan_tables:
+            # Steps counted from the first scanned cell; out_of_steps is the first one out of bounds
+            out_of_steps = self.ray_length(direction)
+            true_steps = self.value_ray(true_value, direction)
+            false_steps = self.value_ray(false_value, direction)
+            if true_value is None:
+                true_steps = np.minimum(true_steps, out_of_steps)
+            if false_value is None:
+                false_steps = np.minimum(false_steps, out_of_steps)
+            table = (true_steps < max_timeout) & (true_steps <= false_steps) & (true_steps <= out_of_steps)
+            self.scan_tables[key] = table.tolist()
+        return self.scan_tables[key]
+
+    def scan(self, direction, true_value, false_value, cell, max_timeout=50):
+        """
+        Same output as scanning(direction, cell_is_value(true_value),
+        cell_is_value(false_value), cell, obs, max_timeout).
+        """
+        if cell is None:
+            return False
+
+        r, c = cell[0] + direction[0], cell[1] + direction[1]
+        if out_of_bounds(r, c, self.obs.shape):
+            return true_value is None
+
+        return self.scan_table(direction, true_value, false_value, max_timeout)[r][c]
+
+def get_observation_index(obs):
+    """
+    The ObservationIndex of obs, built once per distinct state.
+
+    Inside observation_index_scope(obs) this is an identity check; otherwise
+    obs is looked up by its contents, which costs O(cells) per call.
+    """
+    if current_index is not None and current_index[0] is obs:
+        return current_index[1]
+
+    if obs.dtype == object:
+        # The bytes of an object array are pointers, so key on the cell values
+        key = (obs.shape, 'O', tuple(obs.ravel().tolist()))
+    else:
+        key = (obs.shape, obs.dtype.str, obs.tobytes())
+    if key not in cached_indices:
+        if len(cached_indices) >= max_num_cached_indices:
+            cached_indices.clear()
+        cached_indices[key] = ObservationIndex(obs)
+    return cached_indices[key]
+
+@contextmanager
+def observation_index_scope(obs):
+    """
+    Look up the index of obs once for a block that evaluates many programs on
+    it, e.g. every program on one example. obs must not change in the block.
+
+        with observation_index_scope(obs):
+            x = [program(obs, cell) for program in programs]
+    """
+    global current_index
+    previous_index = current_index
+    current_index = (obs, get_observation_index(obs))
+    try:
+        yield current_index[1]
+    finally:
+        current_index = previous_index
+
+
 
 ### Grammatical Prior
 START, CONDITION, LOCAL_PROGRAM, DIRECTION, POSITIVE_NUM, NEGATIVE_NUM, VALUE = range(7)
 
+class OpenNumber(object):
+    """
+    A number nonterminal in the integer-node grammar (create_grammar(..., integer_numbers=True)).
+
+    Stands for a number with magnitude at least abs(value). Expanding it gives the
+    integer value (stop_prob) or the next OpenNumber (continue_prob), so a long
+    offset is a single node instead of a chain of nested '+1' lists.
+    """
+    def __init__(self, value, stop_prob, continue_prob):
+        self.value = value
+        self.stop_prob = stop_prob
+        self.continue_prob = continue_prob
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return 'OpenNumber({})'.format(self.value)
+
+    def expand(self):
+        step = 1 if self.value > 0 else -1
+        substitutions = [str(self.value), OpenNumber(self.value + step, self.stop_prob, self.continue_prob)]
+        return substitutions, [self.stop_prob, self.continue_prob]
+
 def get_grammar_regex(object_types):
     pos_int_regex = '[1-9]\d*'
     neg_int_regex = '-' + pos_int_regex
@@ -110,7 +280,12 @@ def get_initial_probs(object_types):
     }
     return regex
 
-def create_grammar(object_types, feature_probs):
+def create_grammar(object_types, feature_probs, integer_numbers=False):
+    """
+    If integer_numbers, POSITIVE_NUM and NEGATIVE_NUM derive integer literals
+    through OpenNumber nodes instead of '1 +1 +1 ...' chains. Programs get the
+    same priors but are written with plain integers (e.g. '( 2 , 0)').
+    """
     grammar_labels = get_grammar_labels(object_types)
     grammar = {
         START : ([['at_cell_with_value(', VALUE, ',', LOCAL_PROGRAM, ', s)'],
@@ -135,5 +310,12 @@ def create_grammar(object_types, feature_probs):
         VALUE : (object_types, 
                  [feature_probs[label] for label in grammar_labels[VALUE]])
     }
+
+    if integer_numbers:
+        for symbol, sign in ((POSITIVE_NUM, 1), (NEGATIVE_NUM, -1)):
+            stop_prob, continue_prob = grammar[symbol][1]
+            grammar[symbol] = ([[str(sign)], [OpenNumber(2 * sign, stop_prob, continue_prob)]],
+                               [stop_prob, continue_prob])
+
     return grammar
     
@@ -1,4 +1,5 @@
 from policy import StateActionProgram
+from scipy.sparse import csc_matrix
 
 import numpy as np
 
@@ -51,11 +52,10 @@ def get_disjunctive_program(conjunctive_programs):
 
     return program
 
-def extract_plp_from_dt(estimator, features, feature_log_probs):
+def get_paths_to_true_leaves(estimator):
     n_nodes = estimator.tree_.node_count
     children_left = estimator.tree_.children_left
     children_right = estimator.tree_.children_right
-    node_to_features = estimator.tree_.feature
     threshold = estimator.tree_.threshold
     value = estimator.tree_.value.squeeze()
 
@@ -79,7 +79,11 @@ def extract_plp_from_dt(estimator, features, feature_log_probs):
             if value[1] > value[0]:
                 true_leaves.append(node_id)
 
-    paths_to_true_leaves = [get_path_to_leaf(leaf, parents) for leaf in true_leaves]
+    return [get_path_to_leaf(leaf, parents) for leaf in true_leaves]
+
+def extract_plp_from_dt(estimator, features, feature_log_probs):
+    node_to_features = estimator.tree_.feature
+    paths_to_true_leaves = get_paths_to_true_leaves(estimator)
 
     conjunctive_programs = []
     program_log_prob = 0.
@@ -96,5 +100,106 @@ def extract_plp_from_dt(estimator, features, feature_log_probs):
 
     return disjunctive_program, program_log_prob
 
+def get_plp_from_clauses(clauses, features, feature_log_probs):
+    """
+    Build the PLP that extract_plp_from_dt would build for a tree with these
+    paths to true leaves.
+
+    Parameters
+    ----------
+    clauses : [ [ (int, bool) ] ]
+        (feature index, is_positive) literals per path.
+    features : [ StateActionProgram ]
+    feature_log_probs : [ float ]
+
+    Returns
+    -------
+    plp : StateActionProgram
+    plp_log_prob : float
+    """
+    conjunctive_programs = []
+    program_log_prob = 0.
 
+    for clause in clauses:
+        path = [(i, 'right' if is_positive else 'left') for i, (_, is_positive) in enumerate(clause)]
+        literal_features = [feature_idx for feature_idx, _ in clause]
+        and_program, log_p = get_conjunctive_program(path, literal_features, features, feature_log_probs)
+        conjunctive_programs.append(and_program)
+        program_log_prob += log_p
 
+    disjunctive_program = get_disjunctive_program(conjunctive_programs)
+
+    if not isinstance(disjunctive_program, StateActionProgram):
+        disjunctive_program = StateActionProgram(disjunctive_program)
+
+    return disjunctive_program, program_log_prob
+
+def extract_plp_clauses_from_dt(estimator, feature_columns):
+    """
+    The PLP of extract_plp_from_dt as a formula over feature columns.
+
+    Parameters
+    ----------
+    estimator : DecisionTreeClassifier
+    feature_columns : [ int ]
+        The column of each feature the estimator was fit on.
+
+    Returns
+    -------
+    clauses : [ [ (int, bool) ] ]
+        A disjunction of conjunctions of (column, is_positive) literals.
+    """
+    node_to_features = estimator.tree_.feature
+    return [[(feature_columns[node_to_features[node_id]], sign == 'right') for node_id, sign in path]
+            for path in get_paths_to_true_leaves(estimator)]
+
+def evaluate_plp_clauses(plp_clauses, x):
+    """
+    Evaluate many PLPs (see extract_plp_clauses_from_dt) on a feature matrix at once.
+
+    Each clause holds when its number of true literals equals its length, which
+    is a sparse matrix product for all clauses and rows together.
+
+    Parameters
+    ----------
+    plp_clauses : [ [ [ (int, bool) ] ] ]
+    x : np.ndarray
+        x.shape = (num_rows, num_columns), boolean feature values.
+
+    Returns
+    -------
+    outputs : np.ndarray
+        outputs.shape = (num_rows, len(plp_clauses)), boolean PLP values.
+    """
+    num_rows, num_columns = x.shape
+    literal_columns, literal_clauses, literal_signs = [], [], []
+    clause_plps = []
+
+    for plp_idx, clauses in enumerate(plp_clauses):
+        for clause in clauses:
+            for column, is_positive in clause:
+                literal_columns.append(column)
+                literal_clauses.append(len(clause_plps))
+                literal_signs.append(is_positive)
+            clause_plps.append(plp_idx)
+
+    num_clauses = len(clause_plps)
+    literal_signs = np.array(literal_signs, dtype=bool)
+    literal_columns = np.array(literal_columns, dtype=int)
+    literal_clauses = np.array(literal_clauses, dtype=int)
+
+    def incidence(mask):
+        return csc_matrix((np.ones(mask.sum(), dtype=np.int32), (literal_clauses[mask], literal_columns[mask])),
+                          shape=(num_clauses, num_columns))
+
+    positive_literals, negative_literals = incidence(literal_signs), incidence(~literal_signs)
+    x = np.asarray(x, dtype=np.int32).T
+
+    # Number of true literals per (clause, row)
+    num_true = positive_literals.dot(x) + (np.asarray(negative_literals.sum(axis=1)) - negative_literals.dot(x))
+    clause_lengths = np.bincount(literal_clauses, minlength=num_clauses)
+    satisfied = (num_true == clause_lengths[:, None]).astype(np.int32)
+
+    clause_to_plp = csc_matrix((np.ones(num_clauses, dtype=np.int32), (np.arange(num_clauses), clause_plps)),
+                               shape=(num_clauses, len(plp_clauses)))
+    return np.asarray(clause_to_plp.T.dot(satisfied) > 0).T
@@ -0,0 +1,112 @@
+from bit_matrix import BitFeatureMatrix
+from scipy.sparse import hstack
+
+import numpy as np
+
+
+class FeatureMatrixStore(object):
+    """
+    Feature columns computed so far, keyed by (environment, demo number, program string).
+
+    Asking for a program set that extends one seen before only runs the new
+    programs and appends their columns to the stored matrix, so sweeps over
+    growing num_programs do linear instead of quadratic work. Columns are kept
+    bit-packed (see BitFeatureMatrix) in a buffer that grows geometrically, so
+    appending does not copy the stored columns every time and column prefixes
+    are views of the buffer.
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.num_columns = {}
+        self.num_rows = {}
+        self.labels = {}
+        self.columns = {}
+        # The csr_matrix of the longest column prefix converted so far
+        self.csr_prefixes = {}
+
+    def append(self, key, new_X):
+        """
+        Append the columns of the BitFeatureMatrix new_X to the buffer of key.
+        """
+        num_columns = self.num_columns.get(key, 0)
+        end = num_columns + new_X.shape[1]
+
+        if key not in self.buffers or end > len(self.buffers[key]):
+            capacity = max(end, 2 * len(self.buffers.get(key, ())))
+            buffer = np.zeros((capacity, new_X.words.shape[1]), dtype=new_X.words.dtype)
+            if key in self.buffers:
+                buffer[:num_columns] = self.buffers[key][:num_columns]
+            # Views returned earlier keep the old buffer alive and unchanged
+            self.buffers[key] = buffer
+
+        self.buffers[key][num_columns:end] = new_X.words
+        self.num_columns[key] = end
+        self.num_rows[key] = new_X.num_rows
+
+    def get_csr_prefix(self, key, num_columns):
+        """
+        The first num_columns stored columns as a csr_matrix. Only columns that
+        were not converted by an earlier call are unpacked.
+        """
+        cached_num_columns, X = self.csr_prefixes.get(key, (0, None))
+
+        if num_columns == cached_num_columns:
+            return X
+        if num_columns < cached_num_columns:
+            return X[:, :num_columns]
+
+        new_X = BitFeatureMatrix(self.buffers[key][cached_num_columns:num_columns], self.num_rows[key]).tocsr()
+        X = new_X if X is None else hstack([X, new_X], format='csr')
+        self.csr_prefixes[key] = (num_columns, X)
+        return X
+
+    def get_features(self, base_class_name, demo_number, programs, run_programs, bit_packed=False):
+        """
+        Parameters
+        ----------
+        base_class_name : str
+        demo_number : int
+        programs : [ StateActionProgram ]
+        run_programs : callable
+            Maps a list of programs to (X, y) for this demonstration with X a
+            BitFeatureMatrix, e.g. a partial of run_programs_on_demonstration.
+        bit_packed : bool
+            If True, return X as a BitFeatureMatrix instead of a csr_matrix.
+
+        Returns
+        -------
+        X : csr_matrix or BitFeatureMatrix
+            X.shape = (num_demo_items, len(programs))
+        y : [ bool ]
+        """
+        key = (base_class_name, demo_number)
+        columns = self.columns.setdefault(key, {})
+
+        new_programs = []
+        seen = set()
+        for program in programs:
+            if str(program) not in columns and str(program) not in seen:
+                seen.add(str(program))
+                new_programs.append(program)
+
+        if len(new_programs) > 0:
+            new_X, y = run_programs(new_programs)
+            self.append(key, new_X)
+            if key not in self.labels:
+                self.labels[key] = y
+            # Only register columns once their data is stored, so a failed run leaves the store unchanged
+            for program in new_programs:
+                columns[str(program)] = len(columns)
+
+        idxs = [columns[str(program)] for program in programs]
+
+        if idxs == list(range(len(idxs))):
+            if not bit_packed:
+                return self.get_csr_prefix(key, len(idxs)), list(self.labels[key])
+            X = BitFeatureMatrix(self.buffers[key][:len(idxs)], self.num_rows[key])
+        else:
+            X = BitFeatureMatrix(self.buffers[key][:self.num_columns[key]], self.num_rows[key])[:, idxs]
+            if not bit_packed:
+                X = X.tocsr()
+
+        return X, list(self.labels[key])
@@ -0,0 +1,194 @@
+from dsl import get_observation_index
+from vectorized_dsl import parse_program
+
+
+def evaluate_local_program_at_none(tree):
+    """
+    Output of a local program at cell=None, which does not depend on the state.
+    """
+    name = tree[0]
+
+    if name == 'condition':
+        return evaluate_local_program_at_none(tree[1])
+    if name == 'shifted':
+        return evaluate_local_program_at_none(tree[2])
+    if name == 'cell_is_value':
+        return None == tree[1]
+    if name == 'scanning':
+        return False
+
+    raise Exception("Unknown local program", name)
+
+def get_scanned_value(tree):
+    """
+    The value of a scanning condition of the form cell_is_value(value), or None
+    if the condition is anything else.
+    """
+    while tree[0] == 'condition':
+        tree = tree[1]
+    if tree[0] == 'cell_is_value':
+        return tree[1:]
+    return None
+
+def offset_code(base, offset):
+    if offset == 0:
+        return base
+    return '({} + {})'.format(base, offset)
+
+
+class FlatProgramGenerator(object):
+    """
+    Generates the source of a single function `program(s, a)` equivalent to a
+    parsed program (see parse_program).
+
+    Local programs are inlined at their cell: shifts become constant offsets,
+    bounds checks and obs lookups are written out, and each distinct
+    at_cell_with_value value is looked up once per call in the state's
+    ObservationIndex. Scanning for cell_is_value conditions is an
+    ObservationIndex.scan lookup; other scanning keeps a loop, in a generated
+    helper with both conditions inlined.
+    """
+    def __init__(self):
+        self.constants = {}
+        self.helpers = []
+        self.value_cells = {}
+        self.uses_index = False
+
+    def get_constant(self, value):
+        for name, constant in self.constants.items():
+            if constant is value or (type(constant) == type(value) and constant == value):
+                return name
+        name = '_v{}'.format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def local_code(self, tree, row, col, row_offset=0, col_offset=0):
+        """
+        Expression for a local program at cell (row + row_offset, col + col_offset)
+        where row and col are names of ints.
+        """
+        name = tree[0]
+
+        if name == 'condition':
+            return self.local_code(tree[1], row, col, row_offset, col_offset)
+        if name == 'shifted':
+            direction = tree[1]
+            return self.local_code(tree[2], row, col, row_offset + direction[0], col_offset + direction[1])
+        if name == 'cell_is_value':
+            r, c = offset_code(row, row_offset), offset_code(col, col_offset)
+            return '(s[{r}, {c}] == {value} if 0 <= {r} < _num_rows and 0 <= {c} < _num_cols else {none})'.format(
+                r=r, c=c, value=self.get_constant(tree[1]), none=None == tree[1])
+        if name == 'scanning':
+            r, c = offset_code(row, row_offset), offset_code(col, col_offset)
+            self.uses_index = True
+            true_value, false_value = get_scanned_value(tree[2]), get_scanned_value(tree[3])
+            if true_value is not None and false_value is not None:
+                return '_index.scan({}, {}, {}, ({}, {}))'.format(tree[1], self.get_constant(true_value[0]),
+                                                                 self.get_constant(false_value[0]), r, c)
+            helper = self.add_scanning_helper(tree)
+            return '{}(s, _index, {}, {}, _num_rows, _num_cols)'.format(helper, r, c)
+
+        raise Exception("Unknown local program", name)
+
+    def add_scanning_helper(self, tree, max_timeout=50):
+        name = '_scan{}'.format(len(self.helpers))
+        # Reserve the name before generating nested helpers
+        self.helpers.append(None)
+        index = len(self.helpers) - 1
+        direction = tree[1]
+        lines = [
+            'def {}(s, _index, r, c, _num_rows, _num_cols):'.format(name),
+            '    for _ in range({}):'.format(max_timeout),
+        ]
+        lines += ['        {} += {}'.format(var, step) for var, step in zip('rc', direction) if step != 0]
+        lines += [
+            '        if {}:'.format(self.local_code(tree[2], 'r', 'c')),
+            '            return True',
+            '        if {}:'.format(self.local_code(tree[3], 'r', 'c')),
+            '            return False',
+            '        if r < 0 or c < 0 or r >= _num_rows or c >= _num_cols:',
+            '            return False',
+            '    return False',
+        ]
+        self.helpers[index] = '\n'.join(lines)
+        return name
+
+    def program_code(self, tree):
+        name = tree[0]
+
+        if name == 'const':
+            return str(tree[1])
+        if name == 'not':
+            return '(not {})'.format(self.program_code(tree[1]))
+        if name in ('and', 'or'):
+            return '(' + ' {} '.format(name).join(self.program_code(t) for t in tree[1]) + ')'
+        if name == 'at_action_cell':
+            return '({} if a is None else {})'.format(evaluate_local_program_at_none(tree[1]),
+                                                       self.local_code(tree[1], '_ar', '_ac'))
+        if name == 'at_cell_with_value':
+            value = self.get_constant(tree[1])
+            index = self.value_cells.setdefault(value, len(self.value_cells))
+            self.uses_index = True
+            return '({} if _none{} else {})'.format(evaluate_local_program_at_none(tree[2]), index,
+                                                     self.local_code(tree[2], '_r{}'.format(index), '_c{}'.format(index)))
+
+        raise Exception("Unknown program", name)
+
+    def generate(self, tree):
+        """
+        Returns
+        -------
+        source : str
+        constants : { str : Any }
+            Values referenced by the source.
+        """
+        body = self.program_code(tree)
+        lines = [
+            'def program(s, a):',
+            '    _num_rows, _num_cols = s.shape',
+            '    _ar, _ac = (0, 0) if a is None else (a[0], a[1])',
+        ]
+        if self.uses_index:
+            lines.append('    _index = _get_index(s)')
+        for value, index in sorted(self.value_cells.items(), key=lambda item: item[1]):
+            lines += [
+                '    _cell = _index.first_cell({})'.format(value),
+                '    _none{} = _cell is None'.format(index),
+                '    _r{i}, _c{i} = (0, 0) if _none{i} else _cell'.format(i=index),
+            ]
+        lines.append('    return {}'.format(body))
+        source = '\n\n'.join(self.helpers + ['\n'.join(lines)]) + '\n'
+        return source, dict(self.constants)
+
+def generate_flat_source(program):
+    """
+    Parameters
+    ----------
+    program : str
+
+    Returns
+    -------
+    source : str
+    constants : { str : Any }
+    """
+    return FlatProgramGenerator().generate(parse_program(program))
+
+def compile_flat_program(program):
+    """
+    Compile a program string into one flat function with the same outputs as
+    eval('lambda s, a: ' + program).
+
+    Parameters
+    ----------
+    program : str
+
+    Returns
+    -------
+    fn : callable
+        fn(s, a) -> bool
+    """
+    source, constants = generate_flat_source(program)
+    namespace = dict(constants)
+    namespace['_get_index'] = get_observation_index
+    exec(compile(source, '<flat program>', 'exec'), namespace)
+    return namespace['program']
@@ -7,6 +7,7 @@ from copy import deepcopy
 import itertools
 import heapq as hq
 import pickle
+import time
 import hashlib
 import numpy as np
 
@@ -14,7 +15,7 @@ import numpy as np
 
 def find_symbol(program):
     for idx, elm in enumerate(program):
-        if isinstance(elm, int):
+        if isinstance(elm, (int, OpenNumber)):
             return elm, idx
         if isinstance(elm, list):
             rec_result = find_symbol(elm)
@@ -38,7 +39,7 @@ def update_program(program, idx, new_symbol):
 def stringify(program):
     if isinstance(program, str):
         return program
-    if isinstance(program, int):
+    if isinstance(program, (int, OpenNumber)):
         raise Exception("Should not stringify incomplete programs")
     s = ''
     for x in program:
@@ -47,7 +48,10 @@ def stringify(program):
 
 def get_child_programs(program, grammar):
     symbol, idx = find_symbol(program)
-    substitutions, production_probs = grammar[symbol]
+    if isinstance(symbol, OpenNumber):
+        substitutions, production_probs = symbol.expand()
+    else:
+        substitutions, production_probs = grammar[symbol]
     priorities = -np.log(production_probs)
 
     for substitution, prob, priority in zip(substitutions, production_probs, priorities):
@@ -58,7 +62,11 @@ def get_child_programs(program, grammar):
 def program_is_complete(program):
     return find_symbol(program) == None
 
-def generate_programs(grammar, start_symbol=0, num_iterations=100000000):
+def generate_programs_from_lists(grammar, start_symbol=0, num_iterations=100000000):
+    """
+    The original nested-list enumeration, which copies the whole program for
+    every child. Kept as the baseline for benchmark_enumeration.
+    """
     queue = []
     counter = itertools.count()
 
@@ -73,3 +81,315 @@ def generate_programs(grammar, start_symbol=0, num_iterations=100000000):
             else:
                 hq.heappush(queue, (priority + child_priority, production_neg_log_prob - np.log(child_production_prob), 
                                     next(counter), child_program))
+
+def is_open_symbol(x):
+    return isinstance(x, (int, OpenNumber)) or (isinstance(x, ProgramNode) and x.open_index is not None)
+
+class ProgramNode(object):
+    """
+    An immutable node of a partial program: the items of one production, the
+    nonterminal it was substituted for and the production's -log probability.
+
+    open_index points at the leftmost child that still contains a nonterminal
+    (None once the node is complete), so the next symbol to expand is found by
+    following pointers instead of rescanning the program. Children are shared
+    between a program and its expansions (see substitute_open_symbol).
+    """
+    __slots__ = ('children', 'symbol', 'neg_log_prob', 'open_index', 'production')
+
+    def __init__(self, children, symbol=None, neg_log_prob=0., open_start=0, production=None):
+        self.children = children
+        self.symbol = symbol
+        self.neg_log_prob = neg_log_prob
+        # Index of the production in CompiledGrammar.labels, if known
+        self.production = production
+        self.open_index = None
+        # Children before open_start are known to be complete
+        for i in range(open_start, len(children)):
+            if is_open_symbol(children[i]):
+                self.open_index = i
+                break
+
+    def __getstate__(self):
+        return (self.children, self.symbol, self.neg_log_prob, self.open_index, self.production)
+
+    def __setstate__(self, state):
+        self.children, self.symbol, self.neg_log_prob, self.open_index, self.production = state
+
+    def __getitem__(self, i):
+        return self.children[i]
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def is_complete(self):
+        return self.open_index is None
+
+def get_open_path(program):
+    """
+    Positions from the root to the leftmost nonterminal of a ProgramNode.
+    """
+    path = []
+    node = program
+    while isinstance(node, ProgramNode):
+        path.append(node.open_index)
+        node = node.children[node.open_index]
+    return path
+
+def get_open_symbol(program):
+    node = program
+    while isinstance(node, ProgramNode):
+        node = node.children[node.open_index]
+    return node
+
+def substitute_open_symbol(program, new_node):
+    """
+    Copy of program with its leftmost nonterminal replaced by new_node.
+
+    Only the nodes on the path to that nonterminal are rebuilt; every other
+    subtree is shared with program.
+    """
+    i = program.open_index
+    child = program.children[i]
+    if isinstance(child, ProgramNode):
+        child = substitute_open_symbol(child, new_node)
+    else:
+        child = new_node
+    children = program.children[:i] + (child,) + program.children[i+1:]
+    return ProgramNode(children, program.symbol, program.neg_log_prob, open_start=i, production=program.production)
+
+class CompiledGrammar(object):
+    """
+    A grammar from create_grammar, compiled once for enumeration.
+
+    Each nonterminal maps to its productions as (children, neg_log_prob,
+    production) tuples: the items of the ProgramNode to substitute, the
+    production's -log probability and its index in labels. OpenNumber
+    productions are compiled the first time each number is reached.
+
+    Given grammar_labels (see get_grammar_labels), the productions used by a
+    program (see get_program_productions) can be rescored under other
+    feature_probs with get_program_log_probs, without enumerating again.
+    """
+    def __init__(self, grammar, grammar_labels=None):
+        self.labels = []
+        self.productions = {}
+        self.number_productions = {}
+        self.number_label_ids = {}
+
+        for symbol, (substitutions, production_probs) in grammar.items():
+            label_ids = [None] * len(substitutions)
+            if grammar_labels is not None:
+                label_ids = list(range(len(self.labels), len(self.labels) + len(substitutions)))
+                self.labels.extend(grammar_labels[symbol])
+            if symbol in (POSITIVE_NUM, NEGATIVE_NUM):
+                self.number_label_ids[symbol] = label_ids
+            self.productions[symbol] = self.compile_productions(substitutions, production_probs, label_ids)
+
+    @staticmethod
+    def compile_productions(substitutions, production_probs, label_ids):
+        productions = []
+        for substitution, neg_log_prob, label_id in zip(substitutions, -np.log(production_probs), label_ids):
+            children = tuple(substitution) if isinstance(substitution, list) else (substitution,)
+            productions.append((children, float(neg_log_prob), label_id))
+        return productions
+
+    def get_productions(self, symbol):
+        if not isinstance(symbol, OpenNumber):
+            return self.productions[symbol]
+
+        key = (symbol.value, symbol.stop_prob, symbol.continue_prob)
+        if key not in self.number_productions:
+            substitutions, production_probs = symbol.expand()
+            label_ids = self.number_label_ids[POSITIVE_NUM if symbol.value > 0 else NEGATIVE_NUM]
+            self.number_productions[key] = self.compile_productions(substitutions, production_probs, label_ids)
+        return self.number_productions[key]
+
+    def get_program_log_probs(self, program_productions, feature_probs):
+        """
+        Parameters
+        ----------
+        program_productions : [ (int, ...) ]
+            See get_program_productions.
+        feature_probs : { str : float }
+
+        Returns
+        -------
+        program_prior_log_probs : [ float ]
+        """
+        assert len(self.labels) > 0, "Compile the grammar with grammar_labels to rescore programs"
+        with np.errstate(divide='ignore'):
+            label_log_probs = np.log([feature_probs[label] for label in self.labels])
+        return [float(label_log_probs[list(productions)].sum()) for productions in program_productions]
+
+def get_program_productions(program):
+    """
+    Indices (into CompiledGrammar.labels) of every production in a ProgramNode.
+    """
+    productions = []
+    stack = [program]
+    while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, ProgramNode):
+            if node.production is not None:
+                productions.append(node.production)
+            stack.extend(node.children)
+    return tuple(productions)
+
+def get_child_nodes(program, grammar):
+    """
+    ProgramNode version of get_child_programs for a CompiledGrammar.
+
+    Yields
+    ------
+    child_program : ProgramNode
+    neg_log_prob : float
+        -log probability of the production applied.
+    """
+    symbol = get_open_symbol(program)
+
+    for children, neg_log_prob, production in grammar.get_productions(symbol):
+        yield substitute_open_symbol(program, ProgramNode(children, symbol, neg_log_prob, production=production)), \
+            neg_log_prob
+
+def get_derivation_cost(program):
+    """
+    Sum of the production -log probabilities in a ProgramNode.
+    """
+    cost = 0.
+    if isinstance(program, ProgramNode):
+        cost += program.neg_log_prob
+        for x in program.children:
+            cost += get_derivation_cost(x)
+    return cost
+
+def generate_programs(grammar, start_symbol=0, num_iterations=100000000, pruner=None):
+    """
+    Best-first enumeration of complete programs in order of prior probability.
+
+    If a pruner (e.g. an ObservationalEquivalencePruner) is given, children it
+    rejects are dropped from the search.
+    """
+    enumerator = ProgramEnumerator(grammar, start_symbol=start_symbol, pruner=pruner)
+
+    for iteration in range(num_iterations):
+        for program_string, prior_log_prob, _ in enumerator.expand():
+            yield StateActionProgram(program_string), prior_log_prob
+
+class ProgramEnumerator(object):
+    """
+    The best-first search behind generate_programs, made resumable.
+
+    Keeps the search frontier and every program emitted so far (see step), so
+    asking for N+k programs after N only does the remaining pops. Can be saved
+    to disk.
+
+    See generate_programs for pruner. With a CompiledGrammar that has labels,
+    the programs can be rescored under other feature_probs (see rescore).
+    """
+    def __init__(self, grammar, start_symbol=0, pruner=None):
+        if not isinstance(grammar, CompiledGrammar):
+            grammar = CompiledGrammar(grammar)
+        self.grammar = grammar
+        self.pruner = pruner
+        self.queue = [(0, 0, 0, ProgramNode((start_symbol,)))]
+        self.counter = 1
+        self.programs = []
+        self.program_prior_log_probs = []
+        self.program_productions = []
+
+    def __len__(self):
+        return len(self.programs)
+
+    def expand(self):
+        """
+        Pop the most probable partial program and expand it.
+
+        Returns
+        -------
+        completed : [ (str, float, ProgramNode) ]
+            The program string, prior log probability and node of each child
+            that is a complete program, in search order.
+        """
+        priority, production_neg_log_prob, _, program = hq.heappop(self.queue)
+        pruner = self.pruner
+        path = get_open_path(program) if pruner is not None else None
+        completed = []
+
+        for child_program, child_priority in get_child_nodes(program, self.grammar):
+            if pruner is not None and not pruner.keep_partial_program(child_program, path):
+                continue
+            if child_program.is_complete():
+                program_string = stringify(child_program)
+                if pruner is not None and not pruner.keep_program(program_string):
+                    continue
+                completed.append((program_string, -production_neg_log_prob - child_priority, child_program))
+            else:
+                hq.heappush(self.queue, (priority + child_priority, production_neg_log_prob + child_priority,
+                                         self.counter, child_program))
+                self.counter += 1
+
+        return completed
+
+    def step(self):
+        for program_string, prior_log_prob, program in self.expand():
+            self.programs.append(StateActionProgram(program_string))
+            self.program_prior_log_probs.append(prior_log_prob)
+            self.program_productions.append(get_program_productions(program))
+
+    def get_programs(self, num_programs):
+        """
+        Returns
+        -------
+        programs : [ StateActionProgram ]
+            The first num_programs programs in the order of generate_programs.
+        program_prior_log_probs : [ float ]
+        """
+        while len(self.programs) < num_programs:
+            self.step()
+        return self.programs[:num_programs], self.program_prior_log_probs[:num_programs]
+
+    def rescore(self, feature_probs, num_programs=None):
+        """
+        Prior log probabilities of the programs enumerated so far under other
+        feature_probs, in enumeration order.
+
+        Returns
+        -------
+        programs : [ StateActionProgram ]
+        program_prior_log_probs : [ float ]
+        """
+        if num_programs is None:
+            num_programs = len(self.programs)
+        else:
+            self.get_programs(num_programs)
+        program_prior_log_probs = self.grammar.get_program_log_probs(self.program_productions[:num_programs], feature_probs)
+        return self.programs[:num_programs], program_prior_log_probs
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f)
+
+def load_program_enumerator(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+def benchmark_enumeration(grammar, num_programs=10000):
+    """
+    Enumeration throughput of generate_programs against the nested-list baseline.
+
+    Returns
+    -------
+    programs_per_second : { str : float }
+    """
+    programs_per_second = {}
+    for name, generator in (('nested_lists', generate_programs_from_lists), ('program_nodes', generate_programs)):
+        start_time = time.time()
+        for _ in itertools.islice(generator(grammar), num_programs):
+            pass
+        programs_per_second[name] = num_programs / (time.time() - start_time)
+        print("{}: {:.0f} programs/sec".format(name, programs_per_second[name]))
+    return programs_per_second
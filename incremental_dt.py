@@ -0,0 +1,127 @@
+from bit_matrix import BitFeatureMatrix, get_column_prefix
+from sklearn.tree import DecisionTreeClassifier
+
+import numpy as np
+
+
+def get_dense_columns(X, columns):
+    """
+    Dense boolean X[:, columns] for a csr_matrix or BitFeatureMatrix.
+    """
+    if isinstance(X, BitFeatureMatrix):
+        return X[:, columns].toarray()
+    return X[:, columns].toarray().astype(bool)
+
+def get_weighted_gini(num_samples, num_positive):
+    """
+    num_samples * gini impurity, the quantity DecisionTreeClassifier minimizes
+    summed over the children of a split.
+    """
+    num_samples = np.asarray(num_samples, dtype=float)
+    num_positive = np.asarray(num_positive, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        impurity = 2. * num_positive * (num_samples - num_positive) / num_samples
+    return np.where(num_samples > 0, impurity, 0.)
+
+
+class IncrementalDecisionTrees(object):
+    """
+    The trees of learn_single_batch_decision_trees for a growing list of
+    columns, as in learn_plps.
+
+    A tree fit on some columns is kept when more columns are added if none of
+    the new columns could change it: at every split node each new column must
+    be strictly worse (in weighted gini) than the chosen split, and it must be
+    constant on every impure leaf. Otherwise the tree is refit from scratch.
+
+    This is an approximation. A kept tree is a tree the greedy learner could
+    have produced on the new columns, but DecisionTreeClassifier breaks ties
+    between equally good columns by a random feature order that depends on
+    the number of columns, so a fresh fit can pick another of the tied
+    columns and give a different PLP. Ties are common (most trees end in
+    splits that several columns make equally pure), so refitting every tree
+    with a tie would leave nothing to reuse.
+    """
+    def __init__(self, X, y, num_dts, tolerance=1e-7):
+        self.X = X
+        self.y = np.asarray(y, dtype=bool)
+        self.num_dts = num_dts
+        self.tolerance = tolerance
+        self.columns = None
+        self.clfs = [None] * num_dts
+        # Per tree: (nodes x rows) membership, samples and positives per node
+        self.node_stats = [None] * num_dts
+        self.num_fits = 0
+        self.num_reuses = 0
+
+    def fit(self, columns):
+        """
+        Parameters
+        ----------
+        columns : [ int ]
+            Columns of X to fit on, usually the previous columns plus some more.
+
+        Returns
+        -------
+        clfs : [ DecisionTreeClassifier ]
+            Fit on X[:, columns], one per seed.
+        """
+        columns = list(columns)
+        refit = list(range(self.num_dts))
+
+        if self.columns is not None and columns[:len(self.columns)] == self.columns:
+            new_x = get_dense_columns(self.X, columns[len(self.columns):])
+            refit = [seed for seed in refit if self.can_change(seed, new_x)]
+
+        if len(refit) > 0:
+            if columns == list(range(len(columns))):
+                X_i = get_column_prefix(self.X, len(columns))
+            else:
+                X_i = self.X[:, columns]
+            if isinstance(X_i, BitFeatureMatrix):
+                X_i = X_i.tocsc(dtype=np.float32)
+
+            for seed in refit:
+                clf = DecisionTreeClassifier(random_state=seed)
+                clf.fit(X_i, self.y)
+                self.clfs[seed] = clf
+
+                membership = clf.decision_path(X_i).T.tocsr().astype(np.int32)
+                num_samples = np.asarray(membership.sum(axis=1)).flatten()
+                num_positive = membership.dot(self.y.astype(np.int32))
+                self.node_stats[seed] = (membership, num_samples, num_positive)
+
+        self.num_fits += len(refit)
+        self.num_reuses += self.num_dts - len(refit)
+        self.columns = columns
+
+        return list(self.clfs)
+
+    def can_change(self, seed, new_x):
+        """
+        Whether adding the columns new_x could change the tree of this seed.
+        """
+        if new_x.shape[1] == 0:
+            return False
+
+        tree = self.clfs[seed].tree_
+        membership, num_samples, num_positive = self.node_stats[seed]
+
+        new_x = new_x.astype(np.int32)
+        num_ones = membership.dot(new_x)
+        num_positive_ones = membership.dot(new_x * self.y[:, None])
+        splits = (num_ones > 0) & (num_ones < num_samples[:, None])
+
+        new_cost = get_weighted_gini(num_ones, num_positive_ones) + \
+            get_weighted_gini(num_samples[:, None] - num_ones, num_positive[:, None] - num_positive_ones)
+
+        is_split = tree.children_left != tree.children_right
+        left, right = tree.children_left[is_split], tree.children_right[is_split]
+        chosen_cost = get_weighted_gini(num_samples[left], num_positive[left]) + \
+            get_weighted_gini(num_samples[right], num_positive[right])
+
+        if np.any(splits[is_split] & (new_cost[is_split] <= chosen_cost[:, None] + self.tolerance)):
+            return True
+
+        impure = ~is_split & (num_positive > 0) & (num_positive < num_samples)
+        return bool(np.any(splits[impure]))
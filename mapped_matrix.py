@@ -0,0 +1,180 @@
+from bit_matrix import BitFeatureMatrix, get_column_prefix
+from scipy.sparse import issparse, csc_matrix, csr_matrix
+
+import glob
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+
+# Process-local map of directory -> (X, y), so each process opens a matrix once
+max_num_mapped_features = 20
+mapped_features = {}
+
+
+def save_mapped_features(directory, X, y):
+    """
+    Write a feature matrix and its labels to a directory of .npy files that
+    load_mapped_features can memory-map.
+
+    A BitFeatureMatrix is stored as its words, a sparse matrix as its data,
+    indices and indptr. The directory is written under a temporary name and
+    renamed into place, so concurrent readers never see a partial matrix.
+
+    Parameters
+    ----------
+    directory : str
+    X : csr_matrix, csc_matrix or BitFeatureMatrix
+    y : [ bool ]
+    """
+    temp_dir = '{}.tmp-{}-{}'.format(directory, os.getpid(), uuid.uuid4().hex)
+    os.makedirs(temp_dir)
+
+    try:
+        if isinstance(X, BitFeatureMatrix):
+            meta = {'format': 'bits', 'shape': list(X.shape)}
+            np.save(os.path.join(temp_dir, 'words.npy'), np.ascontiguousarray(X.words))
+        else:
+            assert issparse(X) and X.format in ('csr', 'csc')
+            meta = {'format': X.format, 'shape': list(X.shape)}
+            for name in ('data', 'indices', 'indptr'):
+                np.save(os.path.join(temp_dir, name + '.npy'), getattr(X, name))
+        np.save(os.path.join(temp_dir, 'y.npy'), np.asarray(y, dtype=np.uint8))
+        with open(os.path.join(temp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(temp_dir, directory)
+    except OSError:
+        # Another process saved the same matrix first
+        if not os.path.isdir(directory):
+            raise
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def load_mapped_features(directory):
+    """
+    Open a feature matrix written by save_mapped_features without copying it.
+
+    The arrays of X are read-only memory maps, so every process that opens the
+    same directory shares one copy in the page cache.
+
+    Returns
+    -------
+    X : csr_matrix, csc_matrix or BitFeatureMatrix
+    y : np.ndarray
+    """
+    if directory in mapped_features:
+        return mapped_features[directory]
+
+    # Drop matrices removed since (see save_mapped_feature_prefix)
+    for stale_directory in [d for d in mapped_features if not os.path.isdir(d)]:
+        del mapped_features[stale_directory]
+
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+    shape = tuple(meta['shape'])
+    if meta['format'] == 'bits':
+        X = BitFeatureMatrix(load('words'), shape[0])
+    else:
+        matrix_class = csr_matrix if meta['format'] == 'csr' else csc_matrix
+        X = matrix_class((load('data'), load('indices'), load('indptr')), shape=shape, copy=False)
+    y = np.array(load('y'))
+
+    if len(mapped_features) >= max_num_mapped_features:
+        mapped_features.clear()
+    mapped_features[directory] = (X, y)
+
+    return X, y
+
+def get_mapped_feature_directories(prefix):
+    """
+    The directories saved by save_mapped_feature_prefix under prefix.
+
+    Returns
+    -------
+    directories : { int : str }
+        Number of columns -> directory.
+    """
+    directories = {}
+    for directory in glob.glob(glob.escape(prefix) + '_*'):
+        suffix = directory[len(prefix) + 1:]
+        if suffix.isdigit() and os.path.isdir(directory):
+            directories[int(suffix)] = directory
+    return directories
+
+def save_mapped_feature_prefix(prefix, X, y):
+    """
+    save_mapped_features to '<prefix>_<number of columns>' for a matrix whose
+    first columns are the columns of every other matrix saved under prefix
+    (e.g. the programs of one enumeration), and remove the smaller ones.
+
+    Returns
+    -------
+    X : csr_matrix, csc_matrix or BitFeatureMatrix
+    y : np.ndarray
+        As loaded by load_mapped_features.
+    """
+    directory = '{}_{}'.format(prefix, X.shape[1])
+    save_mapped_features(directory, X, y)
+
+    for num_columns, smaller_directory in get_mapped_feature_directories(prefix).items():
+        if num_columns < X.shape[1]:
+            # Renamed first, so readers never see a partly removed matrix
+            removed_directory = '{}.tmp-{}-{}'.format(smaller_directory, os.getpid(), uuid.uuid4().hex)
+            try:
+                os.rename(smaller_directory, removed_directory)
+            except OSError:
+                # Another process removed it first
+                continue
+            shutil.rmtree(removed_directory, ignore_errors=True)
+
+    return load_mapped_features(directory)
+
+def load_mapped_feature_prefix(prefix, num_columns):
+    """
+    The first num_columns columns of the smallest matrix saved under prefix
+    by save_mapped_feature_prefix that has that many, without copying a
+    BitFeatureMatrix.
+
+    Returns
+    -------
+    X : csr_matrix, csc_matrix or BitFeatureMatrix
+    y : np.ndarray
+        Or None if no matrix under prefix has num_columns columns.
+    """
+    while True:
+        directories = get_mapped_feature_directories(prefix)
+        sizes = [n for n in directories if n >= num_columns]
+        if len(sizes) == 0:
+            return None
+        directory = directories[min(sizes)]
+
+        try:
+            X, y = load_mapped_features(directory)
+        except (IOError, OSError):
+            if os.path.isdir(directory):
+                raise
+            # Replaced by a larger matrix since it was found
+            continue
+
+        if num_columns < X.shape[1]:
+            X = get_column_prefix(X, num_columns)
+        return X, y
+
+def get_mapped_words_filename(X):
+    """
+    The words file of a BitFeatureMatrix opened by load_mapped_features (or
+    of a prefix of its columns), or None for any other matrix. Workers can map
+    it with get_shared_array.
+    """
+    if not isinstance(X, BitFeatureMatrix):
+        return None
+    for directory, (mapped_X, _) in mapped_features.items():
+        if isinstance(mapped_X, BitFeatureMatrix) and mapped_X.num_rows == X.num_rows and \
+                mapped_X.words.ctypes.data == X.words.ctypes.data:
+            return os.path.join(directory, 'words.npy')
+    return None
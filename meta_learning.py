@@ -0,0 +1,203 @@
+"""
+Run the meta-learning experiments of upweighting_probs.py for several games
+in parallel.
+
+    python meta_learning.py TwoPileNim Chase StopTheFall
+
+Every game runs learn_probs as in `python pipeline.py <game>` (epsilon=1,
+analyze_improvement=True) in its own process, which uses its share of the
+workers for its own parallel work (see WorkerPool). learn_probs saves a
+checkpoint after every iteration, so after a crash a rerun resumes each game
+after its last finished iteration, and finished games are kept in a
+ResultStore and not run again.
+
+Writes to results_dir:
+- <game>.csv: the probs after every pass over the grammar levels, in the
+  layout heatmap.py reads.
+- <game>_improvement.csv: the num_programs curves learn_probs tested, up to
+  the first one that solves every test environment, for every iteration that
+  was kept.
+- <game>_improvement.png, from learn_probs.
+"""
+from dsl import START, CONDITION, LOCAL_PROGRAM, DIRECTION, POSITIVE_NUM, NEGATIVE_NUM, VALUE, get_grammar_labels
+from env_settings import get_object_types
+from pool_utils import WorkerPool, get_num_workers
+from upweighting_probs import learn_probs
+
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import uuid
+
+result_store_dir = 'meta_learning_store'
+results_dir = 'results'
+
+# Row labels of the probs CSV as heatmap.py shows them; offsets drop the space before the comma
+heatmap_labels = {
+    'at_cell_with_value' : 'at_cell_with_value(V, C)',
+    'at_action_cell' : 'at_action_cell(C)',
+    'shifted' : 'shifted(O,B)',
+    'condition' : 'B',
+    'cell_is_value' : 'cell_is_value(V)',
+    'scanning' : 'scanning(O,C,C)',
+}
+
+
+class ResultStore(object):
+    """
+    Finished jobs as one JSON file per job, named by a hash of the job.
+
+    Files are written under a temporary name and renamed into place, so a
+    crash never leaves a partial result.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def get_filename(self, job, suffix='.json'):
+        key = hashlib.sha1(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{}_{}_{}{}'.format(job[0], job[1], key, suffix))
+
+    def get_checkpoint_filename(self, job):
+        """
+        Where the job can save its progress before it finishes.
+        """
+        return self.get_filename(job, '.checkpoint.json')
+
+    def __contains__(self, job):
+        return os.path.isfile(self.get_filename(job))
+
+    def get(self, job):
+        with open(self.get_filename(job)) as f:
+            return json.load(f)['result']
+
+    def put(self, job, result):
+        filename = self.get_filename(job)
+        temp_filename = '{}.tmp-{}'.format(filename, uuid.uuid4().hex)
+        with open(temp_filename, 'w') as f:
+            json.dump({'job': job, 'result': result}, f)
+        os.replace(temp_filename, filename)
+
+def get_game_parameters(base_class_name):
+    """
+    Returns
+    -------
+    program_generation_step_size : int
+    num_programs : int
+    """
+    if base_class_name == "TwoPileNim":
+        return 1, 250
+    return 10, 1000
+
+def get_learn_probs_job(base_class_name, iters=21, pool_size=None):
+    return ['learn_probs', base_class_name, iters, pool_size]
+
+def get_heatmap_rows(base_class_name):
+    """
+    The rows of the probs CSV in the order of heatmap.get_layers: programs,
+    conditions, base conditions, offsets, numbers and values.
+
+    Returns
+    -------
+    rows : [ (str, str) ]
+        Grammar label and CSV label.
+    """
+    grammar_labels = get_grammar_labels(get_object_types(base_class_name))
+    # test_program has no row in the heatmap
+    programs = [label for label in grammar_labels[START] if label != 'test_program']
+    # shifted(O,B) is shown before its base condition B
+    conditions = sorted(grammar_labels[LOCAL_PROGRAM], key=lambda label: label != 'shifted')
+    labels = programs + conditions + list(grammar_labels[CONDITION]) + list(grammar_labels[DIRECTION]) + \
+        list(grammar_labels[POSITIVE_NUM]) + list(grammar_labels[NEGATIVE_NUM]) + list(grammar_labels[VALUE])
+    return [(label, heatmap_labels.get(label, label.replace(' ,', ','))) for label in labels]
+
+def run_learn_probs(base_class_name, iters=21, pool_size=None, num_workers=None):
+    """
+    Process target for run_meta_learning: learn_probs as in
+    `python pipeline.py <game>`, resumed from and checkpointed to the result
+    store, with the result put in the store when it finishes.
+    """
+    store = ResultStore(result_store_dir)
+    job = get_learn_probs_job(base_class_name, iters, pool_size)
+    program_generation_step_size, num_programs = get_game_parameters(base_class_name)
+
+    with WorkerPool(num_workers):
+        _, probs_history, reverted, improvement_results = learn_probs(
+            base_class_name, program_generation_step_size, num_programs, iters=iters, epsilon=1,
+            analyze_improvement=True, pool_size=pool_size, return_history=True, out_dir=results_dir,
+            checkpoint_file=store.get_checkpoint_filename(job))
+
+    store.put(job, {'probs_history': probs_history, 'reverted': reverted, 'improvement_results': improvement_results})
+    os.remove(store.get_checkpoint_filename(job))
+
+def run_meta_learning(base_class_names, num_workers=None, iters=21, pool_size=None):
+    """
+    Run learn_probs for every game in base_class_names at the same time, each
+    in its own process with an equal share of num_workers workers, and write
+    the results (see write_results).
+
+    Games already in the result store are not run again. A game that fails is
+    reported, and a later call resumes it from its checkpoint.
+    """
+    if num_workers is None:
+        num_workers = get_num_workers()
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+
+    store = ResultStore(result_store_dir)
+    jobs = {base_class_name: get_learn_probs_job(base_class_name, iters, pool_size)
+            for base_class_name in base_class_names}
+    pending = [base_class_name for base_class_name in base_class_names if jobs[base_class_name] not in store]
+
+    # Processes, unlike pool workers, are not daemonic, so each game can start its own WorkerPool
+    processes = []
+    for base_class_name in pending:
+        process = multiprocessing.Process(target=run_learn_probs, name=base_class_name,
+                                          args=(base_class_name, iters, pool_size,
+                                                max(1, num_workers // len(pending))))
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            print("learn_probs failed for {} (exit code {}); run again to resume it".format(
+                process.name, process.exitcode))
+
+    for base_class_name in base_class_names:
+        if jobs[base_class_name] in store:
+            write_results(base_class_name, store.get(jobs[base_class_name]))
+
+def write_results(base_class_name, learned):
+    """
+    Write the probs CSV and the improvement curve CSV of a game.
+    """
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+
+    probs_history = learned['probs_history']
+
+    # As in the existing results: one column per pass over the grammar levels
+    num_levels = len(get_grammar_labels(get_object_types(base_class_name)))
+    iterations = list(range(0, len(probs_history), num_levels))
+    with open(os.path.join(results_dir, base_class_name + '.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([''] + iterations)
+        for label, row_label in get_heatmap_rows(base_class_name):
+            writer.writerow([row_label] + [probs_history[i][label] for i in iterations])
+
+    # Reverted iterations have no curve
+    with open(os.path.join(results_dir, base_class_name + '_improvement.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['iteration', 'num_programs', 'fraction_solved'])
+        for iteration, (xs, ys) in enumerate(learned['improvement_results']):
+            if not learned['reverted'][iteration]:
+                for x, y in zip(xs, ys):
+                    writer.writerow([iteration, x, y])
+
+if __name__  == "__main__":
+    run_meta_learning(sys.argv[1:])
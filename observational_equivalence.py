@@ -0,0 +1,137 @@
+from dsl import LOCAL_PROGRAM, CONDITION
+from grammar_utils import ProgramNode, get_derivation_cost, stringify
+from vectorized_dsl import parse_program, parse_local_program, evaluate_program_grid, evaluate_local_program_grid
+
+import ast
+import numpy as np
+
+
+def get_reach(tree):
+    """
+    Chebyshev distance beyond which a local program only looks at out-of-bounds cells.
+    """
+    name = tree[0]
+
+    if name == 'condition':
+        return get_reach(tree[1])
+    if name == 'shifted':
+        return max(abs(d) for d in tree[1]) + get_reach(tree[2])
+    if name == 'cell_is_value':
+        return 0
+    if name == 'scanning':
+        return max(abs(d) for d in tree[1]) + max(get_reach(tree[2]), get_reach(tree[3]))
+
+    raise Exception("Unknown local program", name)
+
+
+class ObservationalEquivalencePruner(object):
+    """
+    Prunes the search of generate_programs / ProgramEnumerator using the
+    demonstration states, as in bottom-up synthesizers.
+
+    - A complete program is dropped if it gives the same output as an earlier
+      program for every action of every demonstration state.
+    - A (partial or complete) program is dropped as soon as one of its local
+      sub-programs is complete and behaves exactly like a cheaper sub-program
+      of the same nonterminal, on every demonstration state, at every cell up
+      to margin cells outside the grid and at cell=None. Every completion is
+      then equivalent to a completion with a higher prior.
+
+    Sub-programs whose reach (see get_reach) is margin or more are never pruned,
+    since beyond that the comparison would no longer cover every cell they can
+    be evaluated at.
+    """
+    def __init__(self, demonstrations, margin=3):
+        self.states = [state for state, _ in demonstrations]
+        self.margin = margin
+        self.program_signatures = set()
+        # (nonterminal, signature) -> (cost, sub-program) of the cheapest sub-program seen
+        self.local_representatives = {}
+        self.local_signatures = {}
+
+    def keep_program(self, program):
+        """
+        Parameters
+        ----------
+        program : str
+            A complete program.
+
+        Returns
+        -------
+        keep : bool
+        """
+        tree = parse_program(program)
+        signature = b''.join(np.packbits(evaluate_program_grid(tree, obs)).tobytes() for obs in self.states)
+
+        if signature in self.program_signatures:
+            return False
+
+        self.program_signatures.add(signature)
+        return True
+
+    def keep_partial_program(self, program, path):
+        """
+        Parameters
+        ----------
+        program : ProgramNode
+            A child program.
+        path : [ int ]
+            Where the last substitution happened (see get_open_path).
+
+        Returns
+        -------
+        keep : bool
+        """
+        # Only sub-programs containing the last substitution can have just been completed
+        completed = []
+        node = program
+        for i in path:
+            node = node[i]
+            if isinstance(node, ProgramNode) and node.symbol in (LOCAL_PROGRAM, CONDITION) and node.is_complete():
+                completed.append(node)
+
+        candidates = []
+        for node in completed:
+            local_program = stringify(node)
+            signature = self.get_local_signature(local_program)
+            if signature is None:
+                continue
+
+            key = (node.symbol, signature)
+            cost = get_derivation_cost(node)
+            representative = self.local_representatives.get(key)
+
+            if representative is not None and cost >= representative[0] and representative[1] != local_program:
+                return False
+            candidates.append((key, cost, local_program))
+
+        # Only programs that are kept may become representatives
+        for key, cost, local_program in candidates:
+            representative = self.local_representatives.get(key)
+            if representative is None or cost < representative[0]:
+                self.local_representatives[key] = (cost, local_program)
+
+        return True
+
+    def get_local_signature(self, local_program):
+        if local_program not in self.local_signatures:
+            tree = parse_local_program(ast.parse(local_program, mode='eval').body)
+
+            if get_reach(tree) >= self.margin:
+                signature = None
+            else:
+                signature = b''.join(self.get_local_outputs(tree, obs) for obs in self.states)
+
+            self.local_signatures[local_program] = signature
+
+        return self.local_signatures[local_program]
+
+    def get_local_outputs(self, tree, obs):
+        margin = self.margin
+        rows, cols = np.indices((obs.shape[0] + 2 * margin, obs.shape[1] + 2 * margin)) - margin
+        outputs = evaluate_local_program_grid(tree, rows, cols, np.ones(rows.shape, dtype=bool), obs)
+
+        none_cell = np.zeros((1, 1), dtype=int)
+        none_output = evaluate_local_program_grid(tree, none_cell, none_cell, np.zeros((1, 1), dtype=bool), obs)
+
+        return np.packbits(np.append(outputs.flatten(), none_output.flatten())).tobytes()
@@ -1,38 +1,119 @@
-from cache_utils import manage_cache
+from bit_matrix import BitFeatureMatrix, bit_hstack, bit_vstack, get_column_prefix
+from bit_tree import learn_bitset_decision_trees
+from cache_utils import OutputCache
 from dsl import *
 from env_settings import *
-from grammar_utils import generate_programs
-from dt_utils import extract_plp_from_dt
-from expert_demonstrations import get_demonstrations
+from incremental_dt import IncrementalDecisionTrees
+from mapped_matrix import save_mapped_feature_prefix, load_mapped_feature_prefix, get_mapped_words_filename
+from grammar_utils import CompiledGrammar, ProgramEnumerator, load_program_enumerator
+from observational_equivalence import ObservationalEquivalencePruner
+from dt_utils import extract_plp_from_dt, extract_plp_clauses_from_dt, evaluate_plp_clauses, get_plp_from_clauses
 from policy import StateActionProgram, PLPPolicy
+from pool_utils import WorkerPool, pool_map, get_num_workers, get_cached_program, get_cached_demonstrations, \
+    share_array, get_shared_array, release_shared_array
+from program_dag import ProgramDAG
 from utils import run_single_episode
 from upweighting_probs import *
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from functools import partial
 from sklearn.tree import DecisionTreeClassifier
 from scipy.special import logsumexp
-from scipy.sparse import csr_matrix, lil_matrix, vstack
+from scipy.sparse import csr_matrix, vstack
 
 import re
 import gym
-import multiprocessing
+import hashlib
 import numpy as np
 import time
 import os
 
 cache_dir = 'cache'
 
+# Set output_cache.cache_dir (e.g. to cache_dir) to keep the outputs of
+# get_program_set, run_all_programs_on_single_demonstration and train on disk
+output_cache = OutputCache()
 
-#@manage_cache(cache_dir, ['.pkl', '.pkl'])
-def get_program_set(base_class_name, num_programs, feature_probs):
+# Set to a directory to keep program enumerators on disk between runs
+enumerator_dir = None
+max_num_enumerators = 4
+enumerators = OrderedDict()
+
+# Set to a directory to keep the stacked feature matrices of
+# run_all_programs_on_demonstrations in memory-mapped files, which other
+# processes and later calls open without copying (see load_mapped_features).
+# Only the largest matrix of each enumeration is kept (see
+# save_mapped_feature_prefix)
+feature_matrix_dir = None
+
+
+def get_enumerator_filename(base_class_name, feature_probs, pruning_demo_numbers=None, integer_numbers=False):
+    key = hashlib.md5(repr((sorted(feature_probs.items()), pruning_demo_numbers, integer_numbers)).encode('utf-8')).hexdigest()
+    return os.path.join(enumerator_dir, "enumerator_{}_{}.pkl".format(base_class_name, key))
+
+def get_program_enumerator(base_class_name, feature_probs, pruning_demo_numbers=None, integer_numbers=False):
+    """
+    Get the resumable enumerator for a game and grammar probabilities.
+
+    Enumerators are kept in memory (the most recent max_num_enumerators) and,
+    if enumerator_dir is set, loaded from disk.
+
+    Parameters
+    ----------
+    base_class_name : str
+    feature_probs : { str : float }
+    pruning_demo_numbers : (int, ...) or None
+        If given, prune observationally equivalent programs on these demonstrations
+        (see ObservationalEquivalencePruner).
+    integer_numbers : bool
+        See create_grammar.
+
+    Returns
+    -------
+    enumerator : ProgramEnumerator
+    """
+    key = (base_class_name, tuple(sorted(feature_probs.items())), pruning_demo_numbers, integer_numbers)
+    filename = None
+    if enumerator_dir is not None:
+        filename = get_enumerator_filename(base_class_name, feature_probs, pruning_demo_numbers, integer_numbers)
+
+    if key in enumerators:
+        enumerators.move_to_end(key)
+        return enumerators[key]
+
+    if filename is not None and os.path.isfile(filename):
+        enumerator = load_program_enumerator(filename)
+    else:
+        object_types = get_object_types(base_class_name)
+        grammar = CompiledGrammar(create_grammar(object_types, feature_probs, integer_numbers=integer_numbers),
+                                  get_grammar_labels(object_types))
+        pruner = None
+        if pruning_demo_numbers is not None:
+            pruner = ObservationalEquivalencePruner(get_cached_demonstrations(base_class_name, pruning_demo_numbers))
+        enumerator = ProgramEnumerator(grammar, pruner=pruner)
+
+    enumerators[key] = enumerator
+    while len(enumerators) > max_num_enumerators:
+        enumerators.popitem(last=False)
+
+    return enumerator
+
+@output_cache.cached()
+def get_program_set(base_class_name, num_programs, feature_probs, pruning_demo_numbers=None, integer_numbers=False):
     """
     Enumerate all programs up to a certain iteration.
 
+    Enumeration resumes from earlier calls with the same feature_probs
+    (see get_program_enumerator).
+
     Parameters
     ----------
     base_class_name : str
     num_programs : int
+    feature_probs : { str : float }
+    pruning_demo_numbers : (int, ...) or None
+    integer_numbers : bool
+        See get_program_enumerator.
 
     Returns
     -------
@@ -41,22 +122,40 @@ def get_program_set(base_class_name, num_programs, feature_probs):
     program_prior_log_probs : [ float ]
         Log probabilities for each program.
     """
-    object_types = get_object_types(base_class_name)
-    grammar = create_grammar(object_types, feature_probs)
-
-    program_generator = generate_programs(grammar)
-    programs = []
-    program_prior_log_probs = []
+    enumerator = get_program_enumerator(base_class_name, feature_probs, pruning_demo_numbers, integer_numbers)
+    num_enumerated = len(enumerator)
 
     print("Generating {} programs".format(num_programs))
-    for _ in range(num_programs):
-        program, lp = next(program_generator)
-        programs.append(program)
-        program_prior_log_probs.append(lp)
+    programs, program_prior_log_probs = enumerator.get_programs(num_programs)
     print("\nDone.")
 
+    if enumerator_dir is not None and len(enumerator) > num_enumerated:
+        if not os.path.exists(enumerator_dir):
+            os.makedirs(enumerator_dir)
+        enumerator.save(get_enumerator_filename(base_class_name, feature_probs, pruning_demo_numbers, integer_numbers))
+
     return programs, program_prior_log_probs
 
+def rescore_program_set(base_class_name, num_programs, feature_probs, enumeration_probs, pruning_demo_numbers=None,
+                        integer_numbers=False):
+    """
+    The program set of get_program_set(base_class_name, num_programs, enumeration_probs),
+    with prior log probabilities under feature_probs instead.
+
+    Program outputs do not depend on the grammar probabilities, so this reuses
+    the enumeration (and any features computed for it) when only the
+    probabilities change, e.g. between iterations of learn_probs.
+
+    Returns
+    -------
+    programs : [ StateActionProgram ]
+        In enumeration order under enumeration_probs.
+    program_prior_log_probs : [ float ]
+        Log probabilities for each program under feature_probs.
+    """
+    enumerator = get_program_enumerator(base_class_name, enumeration_probs, pruning_demo_numbers, integer_numbers)
+    return enumerator.rescore(feature_probs, num_programs)
+
 def extract_examples_from_demonstration_item(demonstration_item):
     """
     Convert a demonstrated (state, action) into positive and negative classification data.
@@ -115,7 +214,33 @@ def extract_examples_from_demonstration(demonstration):
 
     return positive_examples, negative_examples
 
-def apply_programs(programs, fn_input):
+def get_example_state_idxs(demonstrations):
+    """
+    The state each row of X comes from.
+
+    Parameters
+    ----------
+    demonstrations : [ [(np.ndarray, (int, int))] ]
+        One demonstration per demo number, in the order their examples are stacked.
+
+    Returns
+    -------
+    state_idxs : np.ndarray
+        state_idxs.shape = (num_examples,), indices into the concatenated demonstrations.
+    """
+    state_idxs = []
+    num_states = 0
+
+    for demonstration in demonstrations:
+        # Positive examples first, then the negatives of each item in order
+        state_idxs.extend(range(num_states, num_states + len(demonstration)))
+        for i, (state, _) in enumerate(demonstration):
+            state_idxs.extend([num_states + i] * (state.size - 1))
+        num_states += len(demonstration)
+
+    return np.array(state_idxs, dtype=int)
+
+def apply_programs(programs, fn_input, flat=False):
     """
     Worker function that applies a list of programs to a single given input.
 
@@ -123,6 +248,8 @@ def apply_programs(programs, fn_input):
     ----------
     programs : [ callable ]
     fn_input : Any
+    flat : bool
+        If True, call each program's flat function (see flat_programs).
 
     Returns
     -------
@@ -130,13 +257,101 @@ def apply_programs(programs, fn_input):
         Program outputs in order.
     """
     x = []
-    for program in programs:
-        x_i = program(*fn_input)
-        x.append(x_i)
+    # Every program sees the same state, so look up its index once
+    with observation_index_scope(fn_input[0]):
+        for program in programs:
+            program = get_cached_program(program)
+            if flat:
+                program = program.get_flat_function()
+            x_i = program(*fn_input)
+            x.append(x_i)
     return x
 
-#@manage_cache(cache_dir, ['.npz', '.pkl'])
-def run_all_programs_on_single_demonstration(base_class_name, num_programs, demo_number, feature_probs, program_interval=1000):
+def apply_programs_on_grid(programs, demonstration_item):
+    """
+    Worker function that applies a list of programs to every action of a single state at once.
+
+    Parameters
+    ----------
+    programs : [ StateActionProgram ]
+    demonstration_item : (np.ndarray, (int, int))
+
+    Returns
+    -------
+    positive_x : np.ndarray
+        positive_x.shape = (1, num_programs), outputs for the demonstrated action.
+    negative_x : np.ndarray
+        negative_x.shape = (num_cells - 1, num_programs), outputs for all other actions
+        in the order of extract_examples_from_demonstration_item.
+    """
+    state, _ = demonstration_item
+    x = np.array([get_cached_program(program).evaluate_grid(state).flatten() for program in programs], dtype=bool).T
+    return split_grid_outputs(x, demonstration_item)
+
+def apply_program_dag(dag, demonstration_item):
+    """
+    Worker function that applies all programs in a ProgramDAG to every action of a single state.
+
+    Parameters
+    ----------
+    dag : ProgramDAG
+    demonstration_item : (np.ndarray, (int, int))
+
+    Returns
+    -------
+    positive_x : BitFeatureMatrix
+    negative_x : BitFeatureMatrix
+        See apply_programs_on_grid.
+    """
+    state, _ = demonstration_item
+    positive_x, negative_x = split_grid_outputs(dag.evaluate(state), demonstration_item)
+    return BitFeatureMatrix.from_dense(positive_x), BitFeatureMatrix.from_dense(negative_x)
+
+def apply_programs_to_demonstration(demonstration, vectorized, program_dag, flat, programs):
+    """
+    Worker function that applies a batch of programs to a whole demonstration.
+
+    Parameters
+    ----------
+    demonstration : [(np.ndarray, (int, int))]
+    vectorized : bool
+    program_dag : bool
+    flat : bool
+        See run_all_programs_on_single_demonstration.
+    programs : [ StateActionProgram ]
+
+    Returns
+    -------
+    X : BitFeatureMatrix
+        Program outputs with examples in the order of extract_examples_from_demonstration.
+    """
+    if program_dag:
+        dag = ProgramDAG(programs)
+        results = [split_grid_outputs(dag.evaluate(item[0]), item) for item in demonstration]
+    elif vectorized:
+        results = [apply_programs_on_grid(programs, item) for item in demonstration]
+    else:
+        positive_examples, negative_examples = extract_examples_from_demonstration(demonstration)
+        x = [apply_programs(programs, fn_input, flat=flat) for fn_input in positive_examples + negative_examples]
+        return BitFeatureMatrix.from_dense(x)
+
+    x = np.vstack([x for x, _ in results] + [x for _, x in results])
+    return BitFeatureMatrix.from_dense(x)
+
+def split_grid_outputs(x, demonstration_item):
+    """
+    Split program outputs for every cell of a state into the demonstrated action
+    and all other actions.
+    """
+    state, action = demonstration_item
+    action_idx = np.ravel_multi_index(action, state.shape)
+    return x[action_idx:action_idx+1], np.delete(x, action_idx, axis=0)
+
+@output_cache.cached(ignore=('program_interval', 'feature_store', 'parallelize_over'))
+def run_all_programs_on_single_demonstration(base_class_name, num_programs, demo_number, feature_probs, program_interval=1000,
+                                             vectorized=False, program_dag=False, feature_store=None,
+                                             parallelize_over='examples', bit_packed=False, pruning_demo_numbers=None,
+                                             integer_numbers=False, flat=False):
     """
     Run all programs up to some iteration on one demonstration.
 
@@ -155,10 +370,31 @@ def run_all_programs_on_single_demonstration(base_class_name, num_programs, demo
     demo_number : int
     program_interval : int
         This interval splits up program batches for parallelization.
+    vectorized : bool
+        If True, evaluate each program on whole grids (see vectorized_dsl)
+        instead of once per (state, action).
+    program_dag : bool
+        If True, evaluate all programs together through a ProgramDAG so that
+        sub-programs shared between programs are computed once per state.
+        Parallelizes over demonstration items instead of program batches.
+    feature_store : FeatureMatrixStore or None
+        If given, only programs that are not already in the store are run.
+    parallelize_over : str
+        'examples' sends every example (or demonstration item) to the workers with
+        a batch of programs. 'programs' partitions the programs into column batches
+        instead, sends the demonstration once per worker and gets back bit-packed columns.
+    bit_packed : bool
+        If True, return X as a BitFeatureMatrix instead of a csr_matrix.
+    pruning_demo_numbers : (int, ...) or None
+    integer_numbers : bool
+        See get_program_enumerator.
+    flat : bool
+        If True, programs evaluated per (state, action) are compiled into flat
+        functions (see flat_programs) instead of nested lambdas.
 
     Returns
     -------
-    X : csr_matrix
+    X : csr_matrix or BitFeatureMatrix
         X.shape = (num_demo_items, num_programs)
     y : [ bool ]
         y.shape = (num_demo_items,)
@@ -166,66 +402,161 @@ def run_all_programs_on_single_demonstration(base_class_name, num_programs, demo
 
     print("Running all programs on {}, {}".format(base_class_name, demo_number))
 
-    programs, _ = get_program_set(base_class_name, num_programs, feature_probs)
+    programs, _ = get_program_set(base_class_name, num_programs, feature_probs, pruning_demo_numbers, integer_numbers)
+
+    demonstration = get_cached_demonstrations(base_class_name, (demo_number,))
+
+    fn = partial(run_programs_on_demonstration, demonstration=demonstration, program_interval=program_interval,
+                 vectorized=vectorized, program_dag=program_dag, parallelize_over=parallelize_over,
+                 bit_packed=bit_packed, flat=flat)
+
+    if feature_store is not None:
+        return feature_store.get_features(base_class_name, demo_number, programs, partial(fn, bit_packed=True),
+                                          bit_packed=bit_packed)
+
+    return fn(programs)
+
+def run_programs_on_demonstration(programs, demonstration, program_interval=1000, vectorized=False, program_dag=False,
+                                  parallelize_over='examples', bit_packed=False, flat=False):
+    """
+    See run_all_programs_on_single_demonstration.
+
+    Parameters
+    ----------
+    programs : [ StateActionProgram ]
+    demonstration : [(np.ndarray, (int, int))]
 
-    demonstration = get_demonstrations(base_class_name, demo_numbers=(demo_number,))
+    Returns
+    -------
+    X : csr_matrix or BitFeatureMatrix
+    y : [ bool ]
+    """
     positive_examples, negative_examples = extract_examples_from_demonstration(demonstration)
     y = [1] * len(positive_examples) + [0] * len(negative_examples)
 
     num_data = len(y)
     num_programs = len(programs)
 
-    X = lil_matrix((num_data, num_programs), dtype=bool)
+    if parallelize_over == 'programs':
+        num_workers = get_num_workers()
+        batch_size = min(program_interval, int(np.ceil(num_programs / num_workers)))
+        program_batches = [[str(p) for p in programs[i:i+batch_size]] for i in range(0, num_programs, batch_size)]
 
-    # This loop avoids memory issues
-    for i in range(0, num_programs, program_interval):
-        end = min(i+program_interval, num_programs)
-        print('Iteration {} of {}'.format(i, num_programs), end='\r')
+        # One chunk of batches per worker, so the demonstration is pickled once per worker
+        fn = partial(apply_programs_to_demonstration, demonstration, vectorized, program_dag, flat)
+        results = pool_map(fn, program_batches, chunksize=int(np.ceil(len(program_batches) / num_workers)))
 
-        num_workers = multiprocessing.cpu_count()
-        pool = multiprocessing.Pool(num_workers)
+        X = bit_hstack(results)
 
-        fn = partial(apply_programs, programs[i:end])
-        fn_inputs = positive_examples + negative_examples
-        
-        results = pool.map(fn, fn_inputs)
-        pool.close()
+    elif program_dag:
+        fn = partial(apply_program_dag, ProgramDAG(programs))
+        results = pool_map(fn, demonstration)
 
-        for X_idx, x in enumerate(results):
-            X[X_idx, i:end] = x
+        X = bit_vstack([x for x, _ in results] + [x for _, x in results])
 
-    X = X.tocsr()
+    else:
+        blocks = []
 
-    print()
-    return X, y
+        # This loop avoids memory issues
+        for i in range(0, num_programs, program_interval):
+            end = min(i+program_interval, num_programs)
+            print('Iteration {} of {}'.format(i, num_programs), end='\r')
+
+            if vectorized:
+                fn = partial(apply_programs_on_grid, programs[i:end])
+                results = pool_map(fn, demonstration)
+
+                x = np.vstack([x for x, _ in results] + [x for _, x in results])
+            else:
+                fn = partial(apply_programs, programs[i:end], flat=flat)
+                fn_inputs = positive_examples + negative_examples
+
+                results = pool_map(fn, fn_inputs)
+
+                x = np.array(results, dtype=bool)
+
+            blocks.append(BitFeatureMatrix.from_dense(x))
 
-def run_all_programs_on_demonstrations(base_class_name, num_programs, demo_numbers, feature_probs):
+        X = bit_hstack(blocks)
+        print()
+
+    if bit_packed:
+        return X, y
+    return X.tocsr(), y
+
+def get_feature_matrix_prefix(base_class_name, demo_numbers, feature_probs, bit_packed=False,
+                              pruning_demo_numbers=None, integer_numbers=False):
+    """
+    Programs are enumerated in the same order for any num_programs, so the
+    feature matrices of every num_programs share one prefix.
+    """
+    key = hashlib.md5(repr((tuple(demo_numbers), sorted(feature_probs.items()), bit_packed,
+                            pruning_demo_numbers, integer_numbers)).encode('utf-8')).hexdigest()
+    return os.path.join(feature_matrix_dir, "features_{}_{}".format(base_class_name, key))
+
+def run_all_programs_on_demonstrations(base_class_name, num_programs, demo_numbers, feature_probs, vectorized=False,
+                                       program_dag=False, feature_store=None, parallelize_over='examples',
+                                       bit_packed=False, pruning_demo_numbers=None, integer_numbers=False, flat=False):
     """
     See run_all_programs_on_single_demonstration.
+
+    If feature_matrix_dir is set, the stacked X and y are saved there once and
+    memory-mapped by every later call with the same arguments and at most as
+    many programs, which gets a prefix of the columns.
     """
+    prefix = None
+    if feature_matrix_dir is not None:
+        prefix = get_feature_matrix_prefix(base_class_name, demo_numbers, feature_probs, bit_packed,
+                                           pruning_demo_numbers, integer_numbers)
+        mapped = load_mapped_feature_prefix(prefix, num_programs)
+        if mapped is not None:
+            return mapped
+
     X, y = None, None
 
     for demo_number in demo_numbers:
-        demo_X, demo_y = run_all_programs_on_single_demonstration(base_class_name, num_programs, demo_number, feature_probs)
+        demo_X, demo_y = run_all_programs_on_single_demonstration(base_class_name, num_programs, demo_number, feature_probs,
+                                                                  vectorized=vectorized, program_dag=program_dag,
+                                                                  feature_store=feature_store, parallelize_over=parallelize_over,
+                                                                  bit_packed=bit_packed,
+                                                                  pruning_demo_numbers=pruning_demo_numbers,
+                                                                  integer_numbers=integer_numbers, flat=flat)
 
         if X is None:
             X = demo_X
             y = demo_y
+        elif bit_packed:
+            X = bit_vstack([X, demo_X])
+            y.extend(demo_y)
         else:
             X = vstack([X, demo_X])
             y.extend(demo_y)
 
     y = np.array(y, dtype=np.uint8)
 
+    if prefix is not None:
+        return save_mapped_feature_prefix(prefix, X, y)
+
     return X, y
 
+def get_sklearn_features(X):
+    """
+    X as the float32 csc_matrix DecisionTreeClassifier fits on.
+    """
+    if isinstance(X, BitFeatureMatrix):
+        return X.tocsc(dtype=np.float32)
+    X = X.tocsc()
+    if X.dtype != np.float32:
+        X = X.astype(np.float32)
+    return X
+
 def learn_single_batch_decision_trees(y, num_dts, X_i):
     """
     Parameters
     ----------
     y : [ bool ]
     num_dts : int
-    X_i : csr_matrix
+    X_i : csr_matrix, csc_matrix or BitFeatureMatrix
 
     Returns
     -------
@@ -233,6 +564,8 @@ def learn_single_batch_decision_trees(y, num_dts, X_i):
     """
     clfs = []
 
+    X_i = get_sklearn_features(X_i)
+
     for seed in range(num_dts):
         clf = DecisionTreeClassifier(random_state=seed)
         clf.fit(X_i, y)
@@ -240,44 +573,232 @@ def learn_single_batch_decision_trees(y, num_dts, X_i):
 
     return clfs
 
-def learn_plps(X, y, programs, program_prior_log_probs, num_dts=5, program_generation_step_size=10):
+def get_column_keys(X):
     """
+    Get a hashable key per column such that equal keys mean equal columns.
+
     Parameters
     ----------
-    X : csr_matrix
+    X : csr_matrix or BitFeatureMatrix
+
+    Returns
+    -------
+    keys : [ bytes ]
+    """
+    if isinstance(X, BitFeatureMatrix):
+        return [X.words[j].tobytes() for j in range(X.shape[1])]
+
+    X = X.tocsc()
+    X.sort_indices()
+    X.eliminate_zeros()
+    return [X.indices[X.indptr[j]:X.indptr[j+1]].tobytes() for j in range(X.shape[1])]
+
+def get_step_columns(X, program_prior_log_probs, program_generation_step_size, deduplicate=False):
+    """
+    The columns of X that learn_plps fits trees on at each step.
+
+    Returns
+    -------
+    step_columns : [ range or [ int ] ]
+        A prefix of the programs per step, or with deduplicate, the sorted
+        representatives (highest prior program per distinct column) of that prefix.
+    """
+    num_programs = len(program_prior_log_probs)
+    step_columns = []
+
+    if deduplicate:
+        column_keys = get_column_keys(X)
+        # column key -> index of the highest prior program seen with that column
+        representatives = {}
+        num_seen = 0
+
+    for i in range(0, num_programs, program_generation_step_size):
+        if deduplicate:
+            for j in range(num_seen, i+1):
+                best = representatives.get(column_keys[j])
+                if best is None or program_prior_log_probs[j] > program_prior_log_probs[best]:
+                    representatives[column_keys[j]] = j
+            num_seen = i+1
+
+            step_columns.append(sorted(representatives.values()))
+        else:
+            step_columns.append(range(i+1))
+
+    return step_columns
+
+def get_columns(X, columns):
+    """
+    X[:, columns], as a zero-copy view when columns is a prefix range (see get_column_prefix).
+    """
+    if isinstance(columns, range):
+        return get_column_prefix(X, len(columns))
+    return X[:, list(columns)]
+
+def learn_shared_decision_trees(filename, num_rows, y, num_dts, columns):
+    """
+    Worker function for learn_decision_trees_in_parallel.
+    """
+    X = BitFeatureMatrix(get_shared_array(filename), num_rows)
+    return learn_single_batch_decision_trees(y, num_dts, get_columns(X, columns))
+
+def learn_decision_trees_in_parallel(X, y, num_dts, step_columns):
+    """
+    Fit learn_single_batch_decision_trees for every step in the worker pool.
+
+    X is written once to a shared array that workers memory-map, instead of
+    being pickled with every job. Each job fits all seeds of one step, and
+    results come back in step order.
+
+    Parameters
+    ----------
+    X : csr_matrix or BitFeatureMatrix
+    y : [ bool ]
+    num_dts : int
+    step_columns : [ range or [ int ] ]
+        See get_step_columns.
+
+    Returns
+    -------
+    step_clfs : [ [ DecisionTreeClassifier ] ]
+    """
+    # A memory-mapped X (see feature_matrix_dir) is already on disk
+    filename = get_mapped_words_filename(X)
+    shared = filename is None
+    if shared:
+        if not isinstance(X, BitFeatureMatrix):
+            X = BitFeatureMatrix.from_sparse(X)
+        filename = share_array(X.words)
+
+    try:
+        fn = partial(learn_shared_decision_trees, filename, X.num_rows, y, num_dts)
+        # Later steps have more columns, so hand them out first
+        order = sorted(range(len(step_columns)), key=lambda step: -len(step_columns[step]))
+        results = pool_map(fn, [step_columns[step] for step in order], chunksize=1)
+    finally:
+        if shared:
+            release_shared_array(filename)
+
+    step_clfs = [None] * len(step_columns)
+    for step, clfs in zip(order, results):
+        step_clfs[step] = clfs
+    return step_clfs
+
+def learn_plps(X, y, programs, program_prior_log_probs, num_dts=5, program_generation_step_size=10, deduplicate=False,
+               return_clauses=False, warm_start=False, parallel=False, learner='sklearn', prior_weight=0.):
+    """
+    Parameters
+    ----------
+    X : csr_matrix or BitFeatureMatrix
     y : [ bool ]
     programs : [ StateActionProgram ]
     program_prior_log_probs : [ float ]
     num_dts : int
     program_generation_step_size : int
+    deduplicate : bool
+        If True, programs with identical columns in X are merged before fitting
+        and only the one with the highest prior (in the current prefix) is kept.
+    return_clauses : bool
+        If True, also return each PLP as clauses over the columns of X
+        (see extract_plp_clauses_from_dt).
+    warm_start : bool
+        If True, keep each tree across steps until the new columns could change
+        it (see IncrementalDecisionTrees) instead of refitting every step. This
+        is an approximation: where columns tie, the PLPs can differ from the
+        ones refitting gives. Off by default.
+    parallel : bool
+        If True, fit the trees of all steps in the worker pool (see
+        learn_decision_trees_in_parallel). The PLPs are the same as serially.
+    learner : str
+        'sklearn' fits DecisionTreeClassifiers. 'bitset' fits BitsetDecisionTrees
+        on the packed columns and builds the PLPs from their clauses.
+    prior_weight : float
+        For the 'bitset' learner, how much split selection favors programs with
+        a higher prior (see BitsetDecisionTree).
 
     Returns
     -------
     plps : [ StateActionProgram ]
     plp_priors : [ float ]
         Log probabilities.
+    plp_clauses : [ [ [ (int, bool) ] ] ]
+        Only if return_clauses.
     """
     plps = []
     plp_priors = []
+    plp_clauses = []
 
-    num_programs = len(programs)
+    assert not (warm_start and parallel), "warm_start fits steps in order and cannot be parallel"
+    assert learner == 'sklearn' or not (warm_start or parallel), "warm_start and parallel need the sklearn learner"
 
-    for i in range(0, num_programs, program_generation_step_size):
-        print("Learning plps with {} programs".format(i))
-        for clf in learn_single_batch_decision_trees(y, num_dts, X[:, :i+1]):
-            plp, plp_prior_log_prob = extract_plp_from_dt(clf, programs, program_prior_log_probs)
+    if learner == 'bitset' and not isinstance(X, BitFeatureMatrix):
+        X = BitFeatureMatrix.from_sparse(X)
+    elif learner == 'sklearn' and not parallel:
+        # Convert once to the layout the trees are fit on, so that every prefix is a view
+        X = get_sklearn_features(X)
+
+    step_columns = get_step_columns(X, program_prior_log_probs, program_generation_step_size, deduplicate)
+
+    if warm_start:
+        trees = IncrementalDecisionTrees(X, y, num_dts)
+
+    if parallel:
+        step_clfs = learn_decision_trees_in_parallel(X, y, num_dts, step_columns)
+
+    for step, feature_columns in enumerate(step_columns):
+        print("Learning plps with {} programs".format(step * program_generation_step_size))
+
+        if deduplicate:
+            features = [programs[j] for j in feature_columns]
+            feature_log_probs = [program_prior_log_probs[j] for j in feature_columns]
+        else:
+            features = programs
+            feature_log_probs = program_prior_log_probs
+
+        if learner == 'bitset':
+            column_log_probs = [program_prior_log_probs[j] for j in feature_columns]
+            for tree in learn_bitset_decision_trees(get_columns(X, feature_columns), y, num_dts, column_log_probs,
+                                                    prior_weight=prior_weight):
+                clauses = tree.get_clauses()
+                plp, plp_prior_log_prob = get_plp_from_clauses(clauses, features, feature_log_probs)
+                plps.append(plp)
+                plp_priors.append(plp_prior_log_prob)
+                if return_clauses:
+                    plp_clauses.append([[(feature_columns[i], is_positive) for i, is_positive in clause]
+                                        for clause in clauses])
+            continue
+
+        if parallel:
+            clfs = step_clfs[step]
+        elif warm_start:
+            clfs = trees.fit(feature_columns)
+        else:
+            clfs = learn_single_batch_decision_trees(y, num_dts, get_columns(X, feature_columns))
+
+        for clf in clfs:
+            plp, plp_prior_log_prob = extract_plp_from_dt(clf, features, feature_log_probs)
             plps.append(plp)
             plp_priors.append(plp_prior_log_prob)
+            if return_clauses:
+                plp_clauses.append(extract_plp_clauses_from_dt(clf, feature_columns))
+
+    if warm_start:
+        print("Reused {} of {} trees".format(trees.num_reuses, trees.num_reuses + trees.num_fits))
 
+    if return_clauses:
+        return plps, plp_priors, plp_clauses
     return plps, plp_priors
 
-def compute_likelihood_single_plp(demonstrations, plp):
+def compute_likelihood_single_plp(demonstrations, plp, size_term=False):
     """
     Parameters
     ----------
     demonstrations : [(np.ndarray, (int, int))]
         State, action pairs.
     plp : StateActionProgram
+    size_term : bool
+        If False, the likelihood is 0 if the plp accepts every demonstrated action
+        and -inf otherwise. If True, each demonstrated action additionally has
+        probability 1 / (number of actions the plp accepts in that state).
     
     Returns
     -------
@@ -291,6 +812,7 @@ def compute_likelihood_single_plp(demonstrations, plp):
         if not plp(obs, action):
             return -np.inf
 
+        if size_term:
             size = 1
 
             for r in range(obs.shape[0]):
@@ -304,19 +826,89 @@ def compute_likelihood_single_plp(demonstrations, plp):
 
     return ll
 
-def compute_likelihood_plps(plps, demonstrations):
+def compute_likelihood_plps(plps, demonstrations, size_term=False):
     """
     See compute_likelihood_single_plp.
     """
-    num_workers = multiprocessing.cpu_count()
-    pool = multiprocessing.Pool(num_workers)
-
-    fn = partial(compute_likelihood_single_plp, demonstrations)
-    likelihoods = pool.map(fn, plps)
-    pool.close()
+    fn = partial(compute_likelihood_single_plp, demonstrations, size_term=size_term)
+    likelihoods = pool_map(fn, plps)
 
     return likelihoods
 
+def compute_likelihood_single_plp_on_demo_numbers(base_class_name, demo_numbers, size_term, plp):
+    """
+    Worker function for compute_likelihood_plps_on_demo_numbers.
+    """
+    return compute_likelihood_single_plp(get_cached_demonstrations(base_class_name, demo_numbers), plp, size_term)
+
+def compute_likelihood_plps_on_demo_numbers(plps, base_class_name, demo_numbers, size_term=False):
+    """
+    compute_likelihood_plps where each worker loads the demonstrations once
+    (see get_cached_demonstrations) instead of receiving them with every task.
+    """
+    fn = partial(compute_likelihood_single_plp_on_demo_numbers, base_class_name, tuple(demo_numbers), size_term)
+    return pool_map(fn, plps)
+
+def get_feature_values(X, rows, columns):
+    """
+    Dense boolean X[rows, columns] for a csr_matrix or BitFeatureMatrix.
+    """
+    columns = list(columns)
+    if isinstance(X, BitFeatureMatrix):
+        return X[:, columns].toarray()[rows]
+    return X[:, columns].tocsr()[rows].toarray().astype(bool)
+
+def compute_likelihood_plps_from_features(plp_clauses, X, y, state_idxs=None, size_term=False):
+    """
+    Same likelihoods as compute_likelihood_plps, computed from the feature matrix
+    instead of running the PLPs.
+
+    Every PLP is a formula over programs whose outputs on the demonstrated
+    (state, action) pairs are the positive rows of X, so all PLPs are scored
+    together with evaluate_plp_clauses. With size_term, the other actions a PLP
+    accepts in each state are counted from the negative rows.
+
+    Parameters
+    ----------
+    plp_clauses : [ [ [ (int, bool) ] ] ]
+        See learn_plps.
+    X : csr_matrix or BitFeatureMatrix
+    y : [ bool ]
+    state_idxs : np.ndarray or None
+        See get_example_state_idxs. Required if size_term.
+    size_term : bool
+        See compute_likelihood_single_plp.
+
+    Returns
+    -------
+    likelihoods : [ float ]
+    """
+    columns = sorted(set(column for clauses in plp_clauses for clause in clauses for column, _ in clause))
+    column_idxs = {column: i for i, column in enumerate(columns)}
+    local_clauses = [[[(column_idxs[column], is_positive) for column, is_positive in clause] for clause in clauses]
+                     for clauses in plp_clauses]
+
+    y = np.asarray(y, dtype=bool)
+
+    if not size_term:
+        x = get_feature_values(X, np.flatnonzero(y), columns)
+        accepts_demonstrations = evaluate_plp_clauses(local_clauses, x).all(axis=0)
+        return list(np.where(accepts_demonstrations, 0., -np.inf))
+
+    outputs = evaluate_plp_clauses(local_clauses, get_feature_values(X, slice(None), columns))
+    accepts_demonstrations = outputs[y].all(axis=0)
+
+    # Number of accepted negative actions per (state, plp)
+    negative_state_idxs = state_idxs[~y]
+    num_states = np.max(state_idxs) + 1
+    state_indicator = csr_matrix((np.ones(len(negative_state_idxs), dtype=np.int32),
+                                  (negative_state_idxs, np.arange(len(negative_state_idxs)))),
+                                 shape=(num_states, len(negative_state_idxs)))
+    sizes = 1 + state_indicator.dot(outputs[~y].astype(np.int32))
+
+    ll = np.log(1. / sizes).sum(axis=0)
+    return list(np.where(accepts_demonstrations, ll, -np.inf))
+
 def select_particles(particles, particle_log_probs, max_num_particles):
     """
     Parameters
@@ -340,16 +932,68 @@ def select_particles(particles, particle_log_probs, max_num_particles):
         pass
     return sorted_particles[:end], sorted_log_probs[:end]
 
-#@manage_cache(cache_dir, '.pkl')
-def train(base_class_name, demo_numbers, program_generation_step_size, num_programs, num_dts, max_num_particles, feature_probs):
-    programs, program_prior_log_probs = get_program_set(base_class_name, num_programs, feature_probs)
-
-    X, y = run_all_programs_on_demonstrations(base_class_name, num_programs, demo_numbers, feature_probs)
-    plps, plp_priors = learn_plps(X, y, programs, program_prior_log_probs, num_dts=num_dts,
-        program_generation_step_size=program_generation_step_size)
+def select_pool_programs(program_prior_log_probs, num_programs):
+    """
+    Indices of the num_programs most probable programs, in order of decreasing
+    prior with ties kept in pool order.
+    """
+    order = sorted(range(len(program_prior_log_probs)), key=lambda i: (-program_prior_log_probs[i], i))
+    return order[:num_programs]
+
+@output_cache.cached(ignore=('feature_store', 'parallelize_over', 'parallel'))
+def train(base_class_name, demo_numbers, program_generation_step_size, num_programs, num_dts, max_num_particles, feature_probs,
+          vectorized=False, program_dag=False, feature_store=None, parallelize_over='examples', bit_packed=False,
+          deduplicate=False, prune_equivalent=False, integer_numbers=False, flat=False, symbolic_likelihood=False,
+          size_term=False, pool_probs=None, pool_size=None, warm_start=False, parallel=False, learner='sklearn',
+          prior_weight=0.):
+    """
+    warm_start, parallel, learner and prior_weight choose how the decision
+    trees are fit (see learn_plps).
+
+    If pool_probs is given, pool_size programs are enumerated and run under
+    pool_probs instead, and the num_programs with the highest prior under
+    feature_probs are selected from them (see select_pool_programs). The pool
+    and its features are the same for any feature_probs, so they are reused
+    (e.g. through feature_store) when only the probabilities change. If
+    num_programs is larger than pool_size, the pool grows to num_programs
+    programs (enumeration resumes, see get_program_set).
+    """
+    pruning_demo_numbers = tuple(demo_numbers) if prune_equivalent else None
+    enumeration_probs, enumeration_size = feature_probs, num_programs
+    if pool_probs is not None:
+        enumeration_probs, enumeration_size = pool_probs, max(pool_size, num_programs)
+
+    X, y = run_all_programs_on_demonstrations(base_class_name, enumeration_size, demo_numbers, enumeration_probs,
+                                              vectorized=vectorized, program_dag=program_dag, feature_store=feature_store,
+                                              parallelize_over=parallelize_over, bit_packed=bit_packed,
+                                              pruning_demo_numbers=pruning_demo_numbers, integer_numbers=integer_numbers,
+                                              flat=flat)
+
+    if pool_probs is None:
+        programs, program_prior_log_probs = get_program_set(base_class_name, num_programs, feature_probs,
+                                                            pruning_demo_numbers, integer_numbers)
+    else:
+        programs, program_prior_log_probs = rescore_program_set(base_class_name, enumeration_size, feature_probs, pool_probs,
+                                                                pruning_demo_numbers, integer_numbers)
+        idxs = select_pool_programs(program_prior_log_probs, num_programs)
+        programs = [programs[i] for i in idxs]
+        program_prior_log_probs = [program_prior_log_probs[i] for i in idxs]
+        X = X[:, idxs]
+    if symbolic_likelihood:
+        plps, plp_priors, plp_clauses = learn_plps(X, y, programs, program_prior_log_probs, num_dts=num_dts,
+            program_generation_step_size=program_generation_step_size, deduplicate=deduplicate,
+            warm_start=warm_start, parallel=parallel, learner=learner, prior_weight=prior_weight, return_clauses=True)
+        state_idxs = None
+        if size_term:
+            state_idxs = get_example_state_idxs([get_cached_demonstrations(base_class_name, (demo_number,))
+                                                 for demo_number in demo_numbers])
+        likelihoods = compute_likelihood_plps_from_features(plp_clauses, X, y, state_idxs=state_idxs, size_term=size_term)
+    else:
+        plps, plp_priors = learn_plps(X, y, programs, program_prior_log_probs, num_dts=num_dts,
+            program_generation_step_size=program_generation_step_size, deduplicate=deduplicate,
+            warm_start=warm_start, parallel=parallel, learner=learner, prior_weight=prior_weight)
 
-    demonstrations = get_demonstrations(base_class_name, demo_numbers=demo_numbers)
-    likelihoods = compute_likelihood_plps(plps, demonstrations)
+        likelihoods = compute_likelihood_plps_on_demo_numbers(plps, base_class_name, demo_numbers, size_term=size_term)
 
     particles = []
     particle_log_probs = []
@@ -368,10 +1012,10 @@ def train(base_class_name, demo_numbers, program_generation_step_size, num_progr
         top_particle_log_probs = np.array(top_particle_log_probs) - logsumexp(top_particle_log_probs)
         top_particle_probs = np.exp(top_particle_log_probs)
         print("top_particle_probs:", top_particle_probs)
-        policy = PLPPolicy(top_particles, top_particle_probs)
+        policy = PLPPolicy(top_particles, top_particle_probs, vectorized=vectorized, flat=flat)
     else:
         print("no nontrivial particles found")
-        policy = PLPPolicy([StateActionProgram("False")], [1.0])
+        policy = PLPPolicy([StateActionProgram("False")], [1.0], vectorized=vectorized, flat=flat)
 
     return policy
 
@@ -400,7 +1044,8 @@ if __name__  == "__main__":
         program_generation_step_size = 1
         num_programs = 250
 
-    probs = learn_probs(base_class_name, program_generation_step_size, num_programs, epsilon = 1, analyze_improvement = True)
-    policy = train(base_class_name, range(11), program_generation_step_size, num_programs, 5, 25, probs)
+    with WorkerPool():
+        probs = learn_probs(base_class_name, program_generation_step_size, num_programs, epsilon = 1, analyze_improvement = True)
+        policy = train(base_class_name, range(11), program_generation_step_size, num_programs, 5, 25, probs)
     test_results = test(policy, base_class_name, range(11, 20), record_videos=True)
     print("Test results:", test_results)
@@ -1,5 +1,8 @@
 from dsl import *
 from env_settings import *
+from compile_cache import get_program_code
+from flat_programs import compile_flat_program
+from vectorized_dsl import parse_program, evaluate_program_grid
 
 import numpy as np
 
@@ -13,12 +16,33 @@ class StateActionProgram(object):
     def __init__(self, program):
         self.program = program
         self.wrapped = None
+        self.tree = None
+        self.flat = None
 
     def __call__(self, *args, **kwargs):
         if self.wrapped is None:
-            self.wrapped = eval('lambda s, a: ' + self.program)
+            self.wrapped = eval(get_program_code(self.program))
         return self.wrapped(*args, **kwargs)
 
+    def evaluate_grid(self, obs):
+        """
+        Evaluate the program for every action in obs at once.
+
+        Returns a boolean mask with obs.shape.
+        """
+        if self.tree is None:
+            self.tree = parse_program(self.program)
+        return evaluate_program_grid(self.tree, obs)
+
+    def get_flat_function(self):
+        """
+        The program compiled into a single flat function (see flat_programs),
+        with the same outputs as calling the program.
+        """
+        if self.flat is None:
+            self.flat = compile_flat_program(self.program)
+        return self.flat
+
     def __repr__(self):
         return self.program
 
@@ -31,6 +55,8 @@ class StateActionProgram(object):
     def __setstate__(self, program):
         self.program = program
         self.wrapped = None
+        self.tree = None
+        self.flat = None
 
     def __add__(self, s):
         if isinstance(s, str):
@@ -47,12 +73,14 @@ class StateActionProgram(object):
         raise Exception()
 
 class PLPPolicy(object):
-    def __init__(self, plps, probs, seed=0, map_choices=True):
+    def __init__(self, plps, probs, seed=0, map_choices=True, vectorized=False, flat=False):
         assert abs(np.sum(probs) - 1.) < 1e-5
 
         self.plps = plps
         self.probs = probs
         self.map_choices = map_choices
+        self.vectorized = vectorized
+        self.flat = flat
         self.rng = np.random.RandomState(seed)
 
         self._action_prob_cache = {}
@@ -75,9 +103,10 @@ class PLPPolicy(object):
 
         action_probs = np.zeros(obs.shape, dtype=np.float32)
 
-        for plp, prob in zip(self.plps, self.probs):
-            for r, c in self.get_plp_suggestions(plp, obs):
-                action_probs[r, c] += prob
+        with observation_index_scope(obs):
+            for plp, prob in zip(self.plps, self.probs):
+                for r, c in self.get_plp_suggestions(plp, obs):
+                    action_probs[r, c] += prob
 
         denom = np.sum(action_probs)
         if denom == 0.:
@@ -88,6 +117,12 @@ class PLPPolicy(object):
         return action_probs
 
     def get_plp_suggestions(self, plp, obs):
+        if self.vectorized:
+            return [(r, c) for r, c in np.argwhere(plp.evaluate_grid(obs))]
+
+        if self.flat:
+            plp = plp.get_flat_function()
+
         suggestions = []
 
         for r in range(obs.shape[0]):
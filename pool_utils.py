@@ -0,0 +1,142 @@
+from expert_demonstrations import get_demonstrations
+from policy import StateActionProgram
+
+import multiprocessing
+import numpy as np
+import os
+import tempfile
+import uuid
+
+active_pool = None
+
+# Process-local caches. In a WorkerPool they live as long as the worker, so each
+# program is compiled and each demonstration loaded once per worker.
+max_num_cached_programs = 100000
+cached_programs = {}
+cached_demonstrations = {}
+
+# Arrays shared with workers through memory-mapped files (see share_array)
+shared_array_dir = None
+max_num_shared_arrays = 100
+shared_arrays = {}
+
+
+class WorkerPool(object):
+    """
+    A long-lived process pool shared by the whole pipeline.
+
+    While the context is active, pool_map uses this pool instead of starting a
+    fresh one for every call.
+
+        with WorkerPool():
+            policy = train(...)
+    """
+    def __init__(self, num_workers=None):
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.num_workers = num_workers
+        self.pool = None
+        self.previous_pool = None
+
+    def __enter__(self):
+        global active_pool
+        self.pool = multiprocessing.Pool(self.num_workers)
+        self.previous_pool = active_pool
+        active_pool = self
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def map(self, fn, inputs, chunksize=None):
+        return self.pool.map(fn, inputs, chunksize=chunksize)
+
+    def shutdown(self):
+        global active_pool
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        if active_pool is self:
+            active_pool = self.previous_pool
+
+def get_num_workers():
+    if active_pool is not None:
+        return active_pool.num_workers
+    return multiprocessing.cpu_count()
+
+def pool_map(fn, inputs, chunksize=None):
+    """
+    Map fn over inputs in parallel, using the active WorkerPool if there is one.
+    """
+    if active_pool is not None:
+        return active_pool.map(fn, inputs, chunksize=chunksize)
+
+    # Pool workers (e.g. jobs of meta_learning.py) cannot start pools of their own
+    if multiprocessing.current_process().daemon:
+        return list(map(fn, inputs))
+
+    pool = multiprocessing.Pool(get_num_workers())
+    results = pool.map(fn, inputs, chunksize=chunksize)
+    pool.close()
+    pool.join()
+    return results
+
+def get_cached_program(program):
+    """
+    Get a copy of program that stays compiled in this process.
+    """
+    program = str(program)
+    if program not in cached_programs:
+        if len(cached_programs) >= max_num_cached_programs:
+            cached_programs.clear()
+        cached_programs[program] = StateActionProgram(program)
+    return cached_programs[program]
+
+def get_cached_demonstrations(base_class_name, demo_numbers):
+    """
+    Load demonstrations once per process.
+    """
+    key = (base_class_name, tuple(demo_numbers))
+    if key not in cached_demonstrations:
+        cached_demonstrations[key] = get_demonstrations(base_class_name, demo_numbers=demo_numbers)
+    return cached_demonstrations[key]
+
+def share_array(array):
+    """
+    Write array to a file that workers can memory-map with get_shared_array.
+
+    Returns
+    -------
+    filename : str
+        Unique per call, so a worker never maps a stale array.
+    """
+    directory = shared_array_dir if shared_array_dir is not None else tempfile.gettempdir()
+    filename = os.path.join(directory, 'shared-{}-{}.npy'.format(os.getpid(), uuid.uuid4().hex))
+    np.save(filename, array)
+    return filename
+
+def get_shared_array(filename):
+    """
+    Read-only memory map of an array written by share_array, opened once per process.
+
+    Maps of files that were released since (see release_shared_array) are
+    dropped first, so workers do not keep deleted files alive.
+    """
+    if filename not in shared_arrays:
+        for stale_filename in [f for f in shared_arrays if not os.path.exists(f)]:
+            del shared_arrays[stale_filename]
+        if len(shared_arrays) >= max_num_shared_arrays:
+            shared_arrays.clear()
+        shared_arrays[filename] = np.load(filename, mmap_mode='r')
+    return shared_arrays[filename]
+
+def release_shared_array(filename):
+    """
+    Remove a file written by share_array. Workers drop their map of it the
+    next time they open a shared array.
+    """
+    shared_arrays.pop(filename, None)
+    if os.path.exists(filename):
+        os.remove(filename)
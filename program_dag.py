@@ -0,0 +1,183 @@
+from vectorized_dsl import parse_program, out_of_bounds_grid
+
+import numpy as np
+
+
+class ProgramDAG(object):
+    """
+    A hash-consed set of programs.
+
+    Every distinct sub-program is stored once and shared by all of its parents,
+    so evaluating the whole set on a state computes each sub-program once per
+    (cell base, offset) instead of once per program that contains it.
+
+    Cells are described relative to a base: 'action' (every cell of the grid)
+    or ('value', v) (the first cell holding v, as in at_cell_with_value), plus
+    an offset accumulated by shifted and scanning.
+    """
+    def __init__(self, programs=()):
+        self.nodes = []
+        self.node_ids = {}
+        self.roots = []
+
+        for program in programs:
+            self.add_program(program)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def intern(self, node):
+        if node not in self.node_ids:
+            self.node_ids[node] = len(self.nodes)
+            self.nodes.append(node)
+        return self.node_ids[node]
+
+    def add_tree(self, tree):
+        name = tree[0]
+
+        if name == 'condition':
+            # condition(c) behaves exactly like c
+            return self.add_tree(tree[1])
+        if name == 'shifted':
+            return self.intern(('shifted', tree[1], self.add_tree(tree[2])))
+        if name == 'scanning':
+            return self.intern(('scanning', tree[1], self.add_tree(tree[2]), self.add_tree(tree[3])))
+        if name in ('at_action_cell', 'not'):
+            return self.intern((name, self.add_tree(tree[1])))
+        if name == 'at_cell_with_value':
+            return self.intern((name, tree[1], self.add_tree(tree[2])))
+        if name in ('and', 'or'):
+            return self.intern((name, tuple(self.add_tree(t) for t in tree[1])))
+
+        return self.intern(tree)
+
+    def add_program(self, program):
+        """
+        Parameters
+        ----------
+        program : StateActionProgram or str
+
+        Returns
+        -------
+        root : int
+            Node id of the program.
+        """
+        root = self.add_tree(parse_program(str(program)))
+        self.roots.append(root)
+        return root
+
+    def evaluate(self, obs):
+        """
+        Evaluate every program for every action in obs.
+
+        Parameters
+        ----------
+        obs : np.ndarray
+
+        Returns
+        -------
+        x : np.ndarray
+            x.shape = (obs.size, num_programs), x[i, j] = programs[j](obs, np.unravel_index(i, obs.shape)).
+        """
+        evaluation = DAGEvaluation(self, obs)
+        x = np.empty((obs.size, len(self.roots)), dtype=bool)
+        for j, root in enumerate(self.roots):
+            x[:, j] = evaluation.program(root).flatten()
+        return x
+
+
+class DAGEvaluation(object):
+    """
+    Memoized evaluation of a ProgramDAG on a single state.
+    """
+    def __init__(self, dag, obs, max_timeout=50):
+        self.nodes = dag.nodes
+        self.obs = obs
+        self.max_timeout = max_timeout
+        self.bases = {}
+        self.local_cache = {}
+        self.program_cache = {}
+
+    def get_base(self, base):
+        if base not in self.bases:
+            if base == 'action':
+                rows, cols = np.indices(self.obs.shape)
+                valid = np.ones(self.obs.shape, dtype=bool)
+            else:
+                matches = np.argwhere(self.obs == base[1])
+                if len(matches) == 0:
+                    rows, cols, valid = np.zeros((1, 1), dtype=int), np.zeros((1, 1), dtype=int), np.zeros((1, 1), dtype=bool)
+                else:
+                    rows, cols, valid = matches[:1, :1], matches[:1, 1:], np.ones((1, 1), dtype=bool)
+            self.bases[base] = (rows, cols, valid)
+        return self.bases[base]
+
+    def local(self, node_id, base, offset):
+        key = (node_id, base, offset)
+        if key not in self.local_cache:
+            self.local_cache[key] = self.compute_local(self.nodes[node_id], base, offset)
+        return self.local_cache[key]
+
+    def compute_local(self, node, base, offset):
+        name = node[0]
+
+        if name == 'shifted':
+            direction = node[1]
+            return self.local(node[2], base, (offset[0] + direction[0], offset[1] + direction[1]))
+
+        rows, cols, valid = self.get_base(base)
+
+        if name == 'cell_is_value':
+            rows, cols = rows + offset[0], cols + offset[1]
+            obs = self.obs
+            in_bounds = valid & ~out_of_bounds_grid(rows, cols, obs.shape)
+            focus = obs[np.clip(rows, 0, obs.shape[0] - 1), np.clip(cols, 0, obs.shape[1] - 1)]
+            return np.where(in_bounds, np.asarray(focus == node[1], dtype=bool), node[1] is None)
+
+        if name == 'scanning':
+            direction, true_id, false_id = node[1:]
+            result = np.zeros(rows.shape, dtype=bool)
+            undecided = valid.copy()
+
+            for step in range(1, self.max_timeout + 1):
+                if not undecided.any():
+                    break
+
+                step_offset = (offset[0] + step * direction[0], offset[1] + step * direction[1])
+
+                true_mask = self.local(true_id, base, step_offset)
+                result |= undecided & true_mask
+                undecided &= ~true_mask
+
+                undecided &= ~self.local(false_id, base, step_offset)
+
+                # prevent infinite loops
+                undecided &= ~out_of_bounds_grid(rows + step_offset[0], cols + step_offset[1], self.obs.shape)
+
+            return result
+
+        raise Exception("Unknown local program", name)
+
+    def program(self, node_id):
+        if node_id not in self.program_cache:
+            self.program_cache[node_id] = self.compute_program(self.nodes[node_id])
+        return self.program_cache[node_id]
+
+    def compute_program(self, node):
+        name = node[0]
+        shape = self.obs.shape
+
+        if name == 'const':
+            return np.full(shape, node[1], dtype=bool)
+        if name == 'not':
+            return ~self.program(node[1])
+        if name == 'and':
+            return np.logical_and.reduce([self.program(child) for child in node[1]])
+        if name == 'or':
+            return np.logical_or.reduce([self.program(child) for child in node[1]])
+        if name == 'at_action_cell':
+            return self.local(node[1], 'action', (0, 0))
+        if name == 'at_cell_with_value':
+            return np.broadcast_to(self.local(node[2], ('value', node[1]), (0, 0)), shape)
+
+        raise Exception("Unknown program", name)
@@ -1,17 +1,44 @@
 from dsl import *
 from env_settings import *
+from feature_store import FeatureMatrixStore
 from pipeline import *
 
+import json
 import math
+import os
 import random
 import re
 import sys
+import uuid
 
 import numpy as np
 import matplotlib.pyplot as plt
 
 def learn_probs(base_class_name, program_generation_step_size, num_programs,
-            iters = 21, epsilon = 1, analyze_improvement = False):
+            iters = 21, epsilon = 1, analyze_improvement = False, pool_size = None, return_history = False,
+            warm_start = False, parallel = False, learner = 'sklearn', prior_weight = 0., out_dir = '',
+            checkpoint_file = None):
+    """
+    If analyze_improvement, the improvement plot is saved to out_dir (see
+    plot_improvement).
+
+    warm_start, parallel, learner and prior_weight are passed to every call of
+    train (see learn_plps).
+
+    If pool_size is given, pool_size programs are enumerated and run once under
+    the initial probs, and every iteration trains on the num_programs of them
+    with the highest prior under its probs (see train), instead of enumerating
+    and running programs again. Runs that need more programs than pool_size
+    (analyze_improvement raises num_programs as it goes) grow the pool.
+
+    If return_history, also return the probs after every iteration (the
+    initial probs first), whether each iteration was reverted and the
+    improvement results (empty unless analyze_improvement).
+
+    If checkpoint_file is given, the state after every iteration is saved
+    there (see save_checkpoint), and a later call with the same arguments
+    resumes after the last saved iteration.
+    """
     # initialize blank probability dictionary
     object_types = get_object_types(base_class_name)
     grammar_regex = get_grammar_regex(object_types)
@@ -23,16 +50,62 @@ def learn_probs(base_class_name, program_generation_step_size, num_programs,
         for level in grammar_regex]
     probs = {k[1]: v for d in probs_dicts for k, v in d.items()}
     print("Initial probs:", probs)
+    probs_history = [dict(probs)]
+    reverted = [False]
+    improvement_results = []
 
-    # train initial policy
-    min_num_programs = num_programs
-    policy = train(base_class_name, range(11), program_generation_step_size, min_num_programs, 5, 25, probs)
-    if analyze_improvement:
-        improvement_results = [test_num_programs(base_class_name, program_generation_step_size, num_programs, probs)]
-        min_num_programs = improvement_results[-1][0][-1] + program_generation_step_size
+    # program outputs do not depend on probs, so share them across iterations
+    feature_store = FeatureMatrixStore()
+    pool_probs = dict(probs) if pool_size is not None else None
 
-    curr_layer = 0
-    for i in range(iters):
+    # the iteration only depends on these, so a checkpoint is only resumed by the same call
+    arguments = [base_class_name, program_generation_step_size, num_programs, iters, epsilon, analyze_improvement,
+                 pool_size, warm_start, learner, prior_weight]
+    checkpoint = None
+    if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+        checkpoint = load_checkpoint(checkpoint_file)
+        if checkpoint['arguments'] != json.loads(json.dumps(arguments)):
+            raise Exception("Checkpoint {} is from another call".format(checkpoint_file))
+
+    if checkpoint is not None:
+        print("Resuming from", checkpoint_file, "after iteration", checkpoint['iteration'])
+        probs_history, reverted = checkpoint['probs_history'], checkpoint['reverted']
+        # the probs after the last saved iteration, by label
+        for probs_dict in probs_dicts:
+            for k in probs_dict:
+                probs_dict[k] = probs_history[-1][k[1]]
+        probs = {k[1]: v for d in probs_dicts for k, v in d.items()}
+        improvement_results = checkpoint['improvement_results']
+        min_num_programs, curr_layer = checkpoint['min_num_programs'], checkpoint['curr_layer']
+        first_iteration = checkpoint['iteration']
+        policy = PLPPolicy([StateActionProgram(plp) for plp in checkpoint['plps']], checkpoint['plp_probs'])
+
+    else:
+        # train initial policy
+        min_num_programs = num_programs
+        policy = train(base_class_name, range(11), program_generation_step_size, min_num_programs, 5, 25, probs,
+                       feature_store=feature_store, pool_probs=pool_probs, pool_size=pool_size,
+                       warm_start=warm_start, parallel=parallel, learner=learner, prior_weight=prior_weight)
+        if analyze_improvement:
+            improvement_results = [test_num_programs(base_class_name, program_generation_step_size, num_programs, probs,
+                                                     feature_store=feature_store, pool_probs=pool_probs, pool_size=pool_size,
+                                                     warm_start=warm_start, parallel=parallel, learner=learner, prior_weight=prior_weight)]
+            min_num_programs = improvement_results[-1][0][-1] + program_generation_step_size
+        curr_layer = 0
+        first_iteration = 0
+
+    def checkpoint_state(iteration):
+        if checkpoint_file is not None:
+            save_checkpoint(checkpoint_file, {
+                'arguments' : arguments, 'iteration' : iteration, 'curr_layer' : curr_layer,
+                'min_num_programs' : min_num_programs, 'probs_history' : probs_history, 'reverted' : reverted,
+                'improvement_results' : improvement_results,
+                'plps' : [plp.program for plp in policy.plps], 'plp_probs' : [float(p) for p in policy.probs]})
+
+    if checkpoint is None:
+        checkpoint_state(0)
+
+    for i in range(first_iteration, iters):
         print("RUNNING META-LEARNING ITERATION", i + 1, "OF", iters)
 
         # update probabilities
@@ -46,13 +119,16 @@ def learn_probs(base_class_name, program_generation_step_size, num_programs,
 
         # train a new policy with given probs
         old_policy = policy
-        policy = train(base_class_name, range(11), program_generation_step_size, min_num_programs, 5, 25, probs)
+        policy = train(base_class_name, range(11), program_generation_step_size, min_num_programs, 5, 25, probs,
+                       feature_store=feature_store, pool_probs=pool_probs, pool_size=pool_size,
+                       warm_start=warm_start, parallel=parallel, learner=learner, prior_weight=prior_weight)
         results = test(policy, base_class_name, record_videos = False)
         print("Test results:", results)
 
         # revert changes if learned policy failed
         if False in results:
-            improvement_results += [([None], [0])]
+            if analyze_improvement:
+                improvement_results += [([None], [0])]
             print("Reverting", curr_layer)
             probs_dicts[curr_layer].update(old_probs_dict)
             probs = {k[1]: v for d in probs_dicts for k, v in d.items()}
@@ -60,21 +136,48 @@ def learn_probs(base_class_name, program_generation_step_size, num_programs,
 
         # update minimum number of programs enumerated if learned policy succeeded
         elif analyze_improvement:
-            improvement_results += [test_num_programs(base_class_name, program_generation_step_size, min_num_programs, probs)]
+            improvement_results += [test_num_programs(base_class_name, program_generation_step_size, min_num_programs, probs,
+                                                      feature_store=feature_store, pool_probs=pool_probs, pool_size=pool_size,
+                                                      warm_start=warm_start, parallel=parallel, learner=learner, prior_weight=prior_weight)]
             min_num_programs = improvement_results[-1][0][-1] + program_generation_step_size
 
         curr_layer = (curr_layer + 1) % len(probs_dicts)
+        probs_history.append(dict(probs))
+        reverted.append(False in results)
+        checkpoint_state(i + 1)
 
     if analyze_improvement:
         print("Improvement results:", improvement_results)
-        plot_improvement(base_class_name, improvement_results)
+        plot_improvement(base_class_name, improvement_results, out_dir = out_dir)
     
     print("Final probs:", probs)
+    if return_history:
+        return probs, probs_history, reverted, improvement_results
     return probs
 
-def test_num_programs(base_class_name, program_generation_step_size, max_num_programs, probs, full_curve = False):
+def save_checkpoint(checkpoint_file, state):
+    """
+    Write the JSON state of learn_probs under a temporary name and rename it
+    into place, so a crash leaves the previous checkpoint intact.
+    """
+    temp_file = '{}.tmp-{}'.format(checkpoint_file, uuid.uuid4().hex)
+    with open(temp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_file, checkpoint_file)
+
+def load_checkpoint(checkpoint_file):
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+def test_num_programs(base_class_name, program_generation_step_size, max_num_programs, probs, full_curve = False,
+                      feature_store = None, pool_probs = None, pool_size = None, warm_start = False, parallel = False,
+                      learner = 'sklearn', prior_weight = 0.):
     plt.clf() # clear figure
 
+    # each num_programs only runs the programs added since the previous one
+    if feature_store is None:
+        feature_store = FeatureMatrixStore()
+
     # initialize data lists
     x = []
     y = []
@@ -84,11 +187,10 @@ def test_num_programs(base_class_name, program_generation_step_size, max_num_pro
         print("Testing with", num_programs, "programs")
 
         # train and test model with given num_programs
-        blockPrint()
-        policy = train(base_class_name, range(11), program_generation_step_size, num_programs + program_generation_step_size, 5, 25, probs)
-        results = test(policy, base_class_name, record_videos = False)
-        fraction = results.count(True) * 1./len(results)
-        enablePrint()
+        fraction = test_single_num_programs(base_class_name, program_generation_step_size, num_programs, probs,
+                                            feature_store = feature_store, pool_probs = pool_probs, pool_size = pool_size,
+                                            warm_start = warm_start, parallel = parallel, learner = learner,
+                                            prior_weight = prior_weight)
 
         # update data lists
         x += [num_programs]
@@ -98,7 +200,22 @@ def test_num_programs(base_class_name, program_generation_step_size, max_num_pro
 
     return (x, y)
 
-def plot_improvement(base_class_name, improvement_results):
+def test_single_num_programs(base_class_name, program_generation_step_size, num_programs, probs, feature_store = None,
+                             pool_probs = None, pool_size = None, warm_start = False, parallel = False,
+                             learner = 'sklearn', prior_weight = 0.):
+    """
+    One point of test_num_programs: the fraction of test environments solved.
+    """
+    blockPrint()
+    policy = train(base_class_name, range(11), program_generation_step_size, num_programs + program_generation_step_size, 5, 25, probs,
+                   feature_store = feature_store, pool_probs = pool_probs, pool_size = pool_size,
+                   warm_start = warm_start, parallel = parallel, learner = learner, prior_weight = prior_weight)
+    results = test(policy, base_class_name, record_videos = False)
+    fraction = results.count(True) * 1./len(results)
+    enablePrint()
+    return fraction
+
+def plot_improvement(base_class_name, improvement_results, out_dir = ''):
     x = list(range(len(improvement_results)))
     y = [res[0][-1] for res in improvement_results]
 
@@ -108,7 +225,7 @@ def plot_improvement(base_class_name, improvement_results):
     plt.xlabel('Iterations of meta-learning')
     plt.ylabel('# features enumerated')
 
-    plt.savefig(base_class_name + "_improvement.png")
+    plt.savefig(os.path.join(out_dir, base_class_name + "_improvement.png"))
 
 def adjust(old, new, epsilon = 0.7):
     adjusted = {}
@@ -142,5 +259,6 @@ if __name__  == "__main__":
         program_generation_step_size = 1
         num_programs = 250
 
-    params = learn_probs(base_class_name, program_generation_step_size, num_programs)
+    with WorkerPool():
+        params = learn_probs(base_class_name, program_generation_step_size, num_programs)
     print("Learned params:", params)
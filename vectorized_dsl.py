@@ -0,0 +1,198 @@
+from dsl import *
+from env_settings import *
+
+import ast
+import numpy as np
+
+
+### Parsing
+def evaluate_literal(node):
+    """
+    Evaluate a value or direction argument (e.g. `tpn.EMPTY`, `( 1 +1 , 0)`).
+    """
+    return eval(compile(ast.Expression(node), '<dsl>', 'eval'), globals())
+
+def parse_local_program(node):
+    """
+    Parse `lambda cell,o : ...` into a tree node.
+    """
+    assert isinstance(node, ast.Lambda)
+    call = node.body
+    name = call.func.id
+    args = call.args
+
+    if name == 'condition':
+        return ('condition', parse_local_program(args[0]))
+    if name == 'shifted':
+        return ('shifted', evaluate_literal(args[0]), parse_local_program(args[1]))
+    if name == 'cell_is_value':
+        return ('cell_is_value', evaluate_literal(args[0]))
+    if name == 'scanning':
+        return ('scanning', evaluate_literal(args[0]), parse_local_program(args[1]), parse_local_program(args[2]))
+
+    raise Exception("Unknown local program", name)
+
+def parse_node(node):
+    if isinstance(node, ast.BoolOp):
+        op = 'and' if isinstance(node.op, ast.And) else 'or'
+        return (op, tuple(parse_node(value) for value in node.values))
+    if isinstance(node, ast.UnaryOp):
+        assert isinstance(node.op, ast.Not)
+        return ('not', parse_node(node.operand))
+    if isinstance(node, ast.Call):
+        name = node.func.id
+        args = node.args
+        if name == 'at_cell_with_value':
+            return ('at_cell_with_value', evaluate_literal(args[0]), parse_local_program(args[1]))
+        if name == 'at_action_cell':
+            return ('at_action_cell', parse_local_program(args[0]))
+        if name == 'test_program':
+            return ('const', False)
+        raise Exception("Unknown program", name)
+
+    return ('const', bool(evaluate_literal(node)))
+
+def parse_program(program):
+    """
+    Parse a program string (as produced by generate_programs or extract_plp_from_dt)
+    into a tree of nested tuples.
+
+    Parameters
+    ----------
+    program : str
+
+    Returns
+    -------
+    tree : tuple
+        (name, *args) where args are values, directions or subtrees.
+    """
+    return parse_node(ast.parse(program.strip(), mode='eval').body)
+
+
+### Whole-grid methods
+# Cells are given as arrays of rows and columns plus a mask that is False
+# wherever the scalar DSL would have cell=None.
+def out_of_bounds_grid(rows, cols, shape):
+    return (rows < 0) | (cols < 0) | (rows >= shape[0]) | (cols >= shape[1])
+
+def cell_is_value_grid(value, rows, cols, valid, obs):
+    in_bounds = valid & ~out_of_bounds_grid(rows, cols, obs.shape)
+    focus = obs[np.clip(rows, 0, obs.shape[0] - 1), np.clip(cols, 0, obs.shape[1] - 1)]
+    return np.where(in_bounds, np.asarray(focus == value, dtype=bool), value is None)
+
+def scanning_grid(direction, true_condition, false_condition, rows, cols, valid, obs, max_timeout=50):
+    result = np.zeros(rows.shape, dtype=bool)
+    undecided = valid.copy()
+
+    for _ in range(max_timeout):
+        if not undecided.any():
+            break
+
+        rows = rows + direction[0]
+        cols = cols + direction[1]
+
+        true_mask = evaluate_local_program_grid(true_condition, rows, cols, valid, obs)
+        result |= undecided & true_mask
+        undecided &= ~true_mask
+
+        undecided &= ~evaluate_local_program_grid(false_condition, rows, cols, valid, obs)
+
+        # prevent infinite loops
+        undecided &= ~out_of_bounds_grid(rows, cols, obs.shape)
+
+    return result
+
+def evaluate_local_program_grid(tree, rows, cols, valid, obs):
+    name = tree[0]
+
+    if name == 'condition':
+        return evaluate_local_program_grid(tree[1], rows, cols, valid, obs)
+    if name == 'shifted':
+        direction = tree[1]
+        return evaluate_local_program_grid(tree[2], rows + direction[0], cols + direction[1], valid, obs)
+    if name == 'cell_is_value':
+        return cell_is_value_grid(tree[1], rows, cols, valid, obs)
+    if name == 'scanning':
+        return scanning_grid(tree[1], tree[2], tree[3], rows, cols, valid, obs)
+
+    raise Exception("Unknown local program", name)
+
+def evaluate_program_grid_node(tree, obs):
+    name = tree[0]
+
+    if name == 'const':
+        return np.full(obs.shape, tree[1], dtype=bool)
+    if name == 'not':
+        return ~evaluate_program_grid_node(tree[1], obs)
+    if name == 'and':
+        return np.logical_and.reduce([evaluate_program_grid_node(t, obs) for t in tree[1]])
+    if name == 'or':
+        return np.logical_or.reduce([evaluate_program_grid_node(t, obs) for t in tree[1]])
+    if name == 'at_action_cell':
+        rows, cols = np.indices(obs.shape)
+        valid = np.ones(obs.shape, dtype=bool)
+        return evaluate_local_program_grid(tree[1], rows, cols, valid, obs)
+    if name == 'at_cell_with_value':
+        # The result does not depend on the action, so evaluate a single cell
+        matches = np.argwhere(obs == tree[1])
+        if len(matches) == 0:
+            rows, cols, valid = np.zeros((1, 1), dtype=int), np.zeros((1, 1), dtype=int), np.zeros((1, 1), dtype=bool)
+        else:
+            rows, cols, valid = matches[:1, :1], matches[:1, 1:], np.ones((1, 1), dtype=bool)
+        return np.broadcast_to(evaluate_local_program_grid(tree[2], rows, cols, valid, obs), obs.shape)
+
+    raise Exception("Unknown program", name)
+
+def evaluate_program_grid(tree, obs):
+    """
+    Evaluate a parsed program at every action cell of obs at once.
+
+    Parameters
+    ----------
+    tree : tuple
+        See parse_program.
+    obs : np.ndarray
+
+    Returns
+    -------
+    mask : np.ndarray
+        mask.shape = obs.shape, mask[r, c] = program(obs, (r, c)).
+    """
+    return np.array(evaluate_program_grid_node(tree, obs), dtype=bool)
+
+
+### Parity with the scalar DSL
+def check_grid_parity(programs, observations):
+    """
+    Assert that whole-grid evaluation agrees with calling each program per cell.
+
+    Parameters
+    ----------
+    programs : [ StateActionProgram ]
+    observations : [ np.ndarray ]
+    """
+    for program in programs:
+        tree = parse_program(program.program)
+        for obs in observations:
+            mask = evaluate_program_grid(tree, obs)
+            for r in range(obs.shape[0]):
+                for c in range(obs.shape[1]):
+                    if bool(program(obs, (r, c))) != mask[r, c]:
+                        raise AssertionError("Grid evaluation differs at {} for {}".format((r, c), program))
+
+
+if __name__  == "__main__":
+    import sys
+    from expert_demonstrations import get_demonstrations
+    from pipeline import get_program_set
+
+    base_class_name = str(sys.argv[1])
+    object_types = get_object_types(base_class_name)
+    grammar_labels = get_grammar_labels(object_types)
+    initial_probs = get_initial_probs(object_types)
+    probs = {label: prob for level in grammar_labels for label, prob in zip(grammar_labels[level], initial_probs[level])}
+
+    programs, _ = get_program_set(base_class_name, 1000, probs)
+    observations = [obs for obs, _ in get_demonstrations(base_class_name, demo_numbers=range(11))]
+    check_grid_parity(programs, observations)
+    print("Grid evaluation matches scalar evaluation for {} programs.".format(len(programs)))